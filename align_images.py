@@ -1,61 +1,146 @@
-import os
-import sys
-import bz2
-import argparse
-from keras.utils import get_file
-from ffhq_dataset.face_alignment import image_align
-from ffhq_dataset.landmarks_detector import LandmarksDetector
-import multiprocessing
-
-LANDMARKS_MODEL_URL = 'http://dlib.net/files/shape_predictor_68_face_landmarks.dat.bz2'
-
-
-def unpack_bz2(src_path):
-    data = bz2.BZ2File(src_path).read()
-    dst_path = src_path[:-4]
-    with open(dst_path, 'wb') as fp:
-        fp.write(data)
-    return dst_path
-
-
-if __name__ == "__main__":
-    """
-    Extracts and aligns all faces from images using DLib and a function from original FFHQ dataset preparation step
-    python align_images.py /raw_images /aligned_images
-    """
-    parser = argparse.ArgumentParser(description='Align faces from input images', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('raw_dir', help='Directory with raw images for face alignment')
-    parser.add_argument('aligned_dir', help='Directory for storing aligned images')
-    parser.add_argument('--output_size', default=1024, help='The dimension of images for input to the model', type=int)
-    parser.add_argument('--x_scale', default=1, help='Scaling factor for x dimension', type=float)
-    parser.add_argument('--y_scale', default=1, help='Scaling factor for y dimension', type=float)
-    parser.add_argument('--em_scale', default=0.1, help='Scaling factor for eye-mouth distance', type=float)
-    parser.add_argument('--use_alpha', default=False, help='Add an alpha channel for masking', type=bool)
-
-    args, other_args = parser.parse_known_args()
-
-    landmarks_model_path = unpack_bz2(get_file('shape_predictor_68_face_landmarks.dat.bz2',
-                                               LANDMARKS_MODEL_URL, cache_subdir='temp'))
-    RAW_IMAGES_DIR = args.raw_dir
-    ALIGNED_IMAGES_DIR = args.aligned_dir
-
-    landmarks_detector = LandmarksDetector(landmarks_model_path)
-    for img_name in os.listdir(RAW_IMAGES_DIR):
-        print('Aligning %s ...' % img_name)
-        try:
-            raw_img_path = os.path.join(RAW_IMAGES_DIR, img_name)
-            fn = face_img_name = '%s_%02d.png' % (os.path.splitext(img_name)[0], 1)
-            if os.path.isfile(fn):
-                continue
-            print('Getting landmarks...')
-            for i, face_landmarks in enumerate(landmarks_detector.get_landmarks(raw_img_path), start=1):
-                try:
-                    print('Starting face alignment...')
-                    face_img_name = '%s_%02d.png' % (os.path.splitext(img_name)[0], i)
-                    aligned_face_path = os.path.join(ALIGNED_IMAGES_DIR, face_img_name)
-                    image_align(raw_img_path, aligned_face_path, face_landmarks, output_size=args.output_size, x_scale=args.x_scale, y_scale=args.y_scale, em_scale=args.em_scale, alpha=args.use_alpha)
-                    print('Wrote result %s' % aligned_face_path)
-                except:
-                    print("Exception in face alignment!")
-        except:
-            print("Exception in landmark detection!")
+import os
+import sys
+import bz2
+import time
+import argparse
+import dlib
+from keras.utils import get_file
+from ffhq_dataset.face_alignment import image_align
+from ffhq_dataset.landmarks_detector import LandmarksDetector
+import multiprocessing
+
+LANDMARKS_MODEL_URL = 'http://dlib.net/files/shape_predictor_68_face_landmarks.dat.bz2'
+DONE_LOG = '.aligned_images' # raw images already processed, one name per line, for resuming
+
+
+def unpack_bz2(src_path):
+    data = bz2.BZ2File(src_path).read()
+    dst_path = src_path[:-4]
+    with open(dst_path, 'wb') as fp:
+        fp.write(data)
+    return dst_path
+
+
+def align_image(landmarks_detector, raw_img_path, aligned_dir, args):
+    # Align every face in one raw image; returns (number of faces written, error messages)
+    img_name = os.path.basename(raw_img_path)
+    faces, errors = 0, []
+    try:
+        # Decoded once; detection and every face's alignment share the same pixel buffer
+        img = dlib.load_rgb_image(raw_img_path)
+        for i, face_landmarks in enumerate(landmarks_detector.get_landmarks(img, args.detect_size), start=1):
+            try:
+                face_img_name = '%s_%02d.png' % (os.path.splitext(img_name)[0], i)
+                aligned_face_path = os.path.join(aligned_dir, face_img_name)
+                image_align(img, aligned_face_path, face_landmarks, output_size=args.output_size, x_scale=args.x_scale, y_scale=args.y_scale, em_scale=args.em_scale, alpha=args.use_alpha,
+                            transform_size=args.transform_size or None, supersample=args.supersample)
+                faces += 1
+            except Exception as e:
+                errors.append("Exception in face alignment: %r" % e)
+    except Exception as e:
+        errors.append("Exception in landmark detection: %r" % e)
+    return faces, errors
+
+
+# One LandmarksDetector per worker process, created by the pool initializer
+_worker_detector = None
+
+def _init_worker(landmarks_model_path):
+    global _worker_detector
+    _worker_detector = LandmarksDetector(landmarks_model_path)
+
+def _align_job(raw_img_path, aligned_dir, args):
+    start = time.time()
+    faces, errors = align_image(_worker_detector, raw_img_path, aligned_dir, args)
+    return raw_img_path, faces, errors, time.time() - start
+
+
+def is_done(img_name, aligned_dir, done):
+    return img_name in done or os.path.isfile(os.path.join(aligned_dir, '%s_%02d.png' % (os.path.splitext(img_name)[0], 1)))
+
+
+if __name__ == "__main__":
+    """
+    Extracts and aligns all faces from images using DLib and a function from original FFHQ dataset preparation step
+    python align_images.py /raw_images /aligned_images
+    """
+    parser = argparse.ArgumentParser(description='Align faces from input images', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('raw_dir', help='Directory with raw images for face alignment')
+    parser.add_argument('aligned_dir', help='Directory for storing aligned images')
+    parser.add_argument('--output_size', default=1024, help='The dimension of images for input to the model', type=int)
+    parser.add_argument('--x_scale', default=1, help='Scaling factor for x dimension', type=float)
+    parser.add_argument('--y_scale', default=1, help='Scaling factor for y dimension', type=float)
+    parser.add_argument('--em_scale', default=0.1, help='Scaling factor for eye-mouth distance', type=float)
+    parser.add_argument('--use_alpha', default=False, help='Add an alpha channel for masking', type=bool)
+    parser.add_argument('--transform_size', default=4096, help='Size of the intermediate warped image; 0 to pick the smallest size needed per face', type=int)
+    parser.add_argument('--supersample', default=1.0, help='With --transform_size 0: supersampling relative to the source resolution of the face', type=float)
+    parser.add_argument('--detect_size', default=0, help='Detect faces on a copy downscaled to this size on its longer side (landmarks still use the full image); 0 to detect at full size', type=int)
+    parser.add_argument('--workers', default=1, help='Number of alignment processes, each with its own landmarks detector; 0 for one per CPU core', type=int)
+    parser.add_argument('--max_in_flight', default=0, help='Maximum number of images queued or being aligned at once; 0 for twice the number of workers', type=int)
+    parser.add_argument('--report_every', default=100, help='Print a throughput line every n images', type=int)
+
+    args, other_args = parser.parse_known_args()
+
+    landmarks_model_path = unpack_bz2(get_file('shape_predictor_68_face_landmarks.dat.bz2',
+                                               LANDMARKS_MODEL_URL, cache_subdir='temp'))
+    RAW_IMAGES_DIR = args.raw_dir
+    ALIGNED_IMAGES_DIR = args.aligned_dir
+    os.makedirs(ALIGNED_IMAGES_DIR, exist_ok=True)
+
+    # Resume: skip raw images already logged as done (including those without faces) or with a first aligned face
+    done_log_path = os.path.join(ALIGNED_IMAGES_DIR, DONE_LOG)
+    done = set()
+    if os.path.isfile(done_log_path):
+        with open(done_log_path) as f:
+            done = set(line.rstrip('\n') for line in f)
+    img_names = sorted(os.listdir(RAW_IMAGES_DIR))
+    todo = [x for x in img_names if not is_done(x, ALIGNED_IMAGES_DIR, done)]
+    print('%d images, %d already aligned, %d to go' % (len(img_names), len(img_names) - len(todo), len(todo)))
+
+    workers = args.workers or multiprocessing.cpu_count()
+    max_in_flight = args.max_in_flight or 2 * workers
+    stats = dict(images=0, faces=0, errors=0, busy=0.0)
+    start = time.time()
+
+    with open(done_log_path, 'a') as done_log:
+        def finished(result):
+            raw_img_path, faces, errors, seconds = result
+            img_name = os.path.basename(raw_img_path)
+            for error in errors:
+                print('%s: %s' % (img_name, error))
+            print('Aligned %s: %d face(s)' % (img_name, faces))
+            done_log.write(img_name + '\n')
+            done_log.flush()
+            stats['images'] += 1
+            stats['faces'] += faces
+            stats['errors'] += len(errors)
+            stats['busy'] += seconds
+            if args.report_every > 0 and stats['images'] % args.report_every == 0:
+                elapsed = time.time() - start
+                print('[%d/%d] %.2f images/s, %.2f faces/s' % (stats['images'], len(todo), stats['images'] / elapsed, stats['faces'] / elapsed))
+
+        if workers == 1:
+            landmarks_detector = LandmarksDetector(landmarks_model_path)
+            for img_name in todo:
+                job_start = time.time()
+                raw_img_path = os.path.join(RAW_IMAGES_DIR, img_name)
+                faces, errors = align_image(landmarks_detector, raw_img_path, ALIGNED_IMAGES_DIR, args)
+                finished((raw_img_path, faces, errors, time.time() - job_start))
+        else:
+            # Results are handled on this thread only; the semaphore bounds the images queued in the pool
+            in_flight = multiprocessing.BoundedSemaphore(max_in_flight)
+            with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(landmarks_model_path,)) as pool:
+                pending = []
+                for img_name in todo:
+                    in_flight.acquire()
+                    pending.append(pool.apply_async(_align_job, (os.path.join(RAW_IMAGES_DIR, img_name), ALIGNED_IMAGES_DIR, args),
+                                                    callback=lambda _: in_flight.release(), error_callback=lambda _: in_flight.release()))
+                    while pending and pending[0].ready():
+                        finished(pending.pop(0).get())
+                for result in pending:
+                    finished(result.get())
+
+    elapsed = time.time() - start
+    print('Aligned %d faces from %d images in %.1f s with %d worker(s): %.2f images/s, %.2f faces/s, %.2f s per image, %d errors'
+          % (stats['faces'], stats['images'], elapsed, workers, stats['images'] / max(elapsed, 1e-6), stats['faces'] / max(elapsed, 1e-6),
+             stats['busy'] / max(stats['images'], 1), stats['errors']))
@@ -0,0 +1,65 @@
+"""Compare adaptive transform sizes in image_align against the fixed 4096px transform: PSNR and time per face."""
+
+import os
+import time
+import json
+import argparse
+import numpy as np
+from keras.utils import get_file
+from ffhq_dataset.face_alignment import image_align
+from ffhq_dataset.landmarks_detector import LandmarksDetector
+from align_images import unpack_bz2, LANDMARKS_MODEL_URL
+
+
+def time_align(raw_img_path, face_landmarks, runs, **kwargs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        img = image_align(raw_img_path, None, face_landmarks, **kwargs)
+    return np.asarray(img, dtype=np.float64), (time.perf_counter() - start) / runs
+
+def psnr(a, b):
+    mse = np.mean(np.square(a - b))
+    return 10 * np.log10(255.0 ** 2 / max(mse, 1e-12))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark adaptive transform sizes for face alignment', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('raw_dir', help='Directory with raw images for face alignment')
+    parser.add_argument('--output_size', default=512, help='The dimension of the aligned images', type=int)
+    parser.add_argument('--supersample', default='1,1.5,2', help='Comma-separated supersampling factors to compare with --transform_size 0')
+    parser.add_argument('--max_images', default=20, help='Number of raw images to use', type=int)
+    parser.add_argument('--runs', default=1, help='Timed runs per face and setting', type=int)
+    parser.add_argument('--json', default='', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    landmarks_model_path = unpack_bz2(get_file('shape_predictor_68_face_landmarks.dat.bz2',
+                                               LANDMARKS_MODEL_URL, cache_subdir='temp'))
+    landmarks_detector = LandmarksDetector(landmarks_model_path)
+    img_names = sorted(os.listdir(args.raw_dir))[:args.max_images]
+    faces = [(os.path.join(args.raw_dir, x), lm) for x in img_names for lm in landmarks_detector.get_landmarks(os.path.join(args.raw_dir, x))]
+    print('%d faces in %d images' % (len(faces), len(img_names)))
+
+    settings = [('4096', dict(transform_size=4096))]
+    settings += [('auto x%g' % s, dict(transform_size=None, supersample=s)) for s in map(float, args.supersample.split(','))]
+    results = {name: dict(seconds=[], psnr=[]) for name, _ in settings}
+    for raw_img_path, face_landmarks in faces:
+        reference = None
+        for name, kwargs in settings:
+            img, seconds = time_align(raw_img_path, face_landmarks, args.runs, output_size=args.output_size, **kwargs)
+            if reference is None:
+                reference = img
+            results[name]['seconds'].append(seconds)
+            results[name]['psnr'].append(psnr(img, reference) if img is not reference else float('inf'))
+
+    print('%-10s %12s %12s %12s %10s' % ('', 'ms / face', 'mean PSNR', 'min PSNR', 'speedup'))
+    base = np.mean(results['4096']['seconds'])
+    summary = {}
+    for name, _ in settings:
+        seconds, psnrs = np.mean(results[name]['seconds']), results[name]['psnr']
+        summary[name] = dict(ms_per_face=1000 * seconds, mean_psnr=float(np.mean(psnrs)), min_psnr=float(np.min(psnrs)), speedup=base / seconds)
+        print('%-10s %12.1f %12.2f %12.2f %9.2fx' % (name, 1000 * seconds, np.mean(psnrs), np.min(psnrs), base / seconds))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(output_size=args.output_size, faces=len(faces), results=summary), f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""Encoder throughput benchmark on a tiny randomly initialized StyleGAN, runnable on CPU-only machines.
+
+Builds a small G_style (e.g. 64px, 64 feature maps) and a stand-in FaceNet graph with random weights. It then runs
+encode_images.run_encoder for each batch size and loss combination with the stage profiler on (model and optimizer
+build, image loading, reference embeddings, optimization steps, result fetches and output writing). Every
+configuration runs in a fresh process; the results are written as JSON and each run's trace and summary are kept
+under <work_dir>/profile.
+"""
+
+import os
+import sys
+import json
+import time
+import pickle
+import argparse
+import platform
+import tempfile
+import itertools
+import multiprocessing as mp
+import PIL.Image
+import numpy as np
+
+LOSSES = {
+    'pixel': ['--use_pixel_loss', '1.5'],
+    'mssim': ['--use_mssim_loss', '100'],
+    'fn': ['--use_fn_loss', '100'],
+    'l1': ['--use_l1_penalty', '0.01'],
+}
+
+
+def build_tiny_stylegan(path, resolution=64, fmap_max=64):
+    import dnnlib.tflib as tflib
+    tflib.init_tf()
+    Gs = tflib.Network('G', func_name='training.networks_stylegan.G_style', num_channels=3, resolution=resolution,
+                       fmap_base=fmap_max * 8, fmap_max=fmap_max, mapping_layers=2, mapping_fmaps=128)
+    with open(path, 'wb') as f:
+        pickle.dump(Gs, f)
+
+def build_standin_facenet(path):
+    # Frozen graph with FaceNet's interface (input, phase_train -> 512-d embeddings) and a tiny random CNN inside
+    import tensorflow as tf
+    graph = tf.Graph()
+    with graph.as_default():
+        images = tf.placeholder(tf.float32, [None, 160, 160, 3], name='input')
+        phase_train = tf.placeholder_with_default(False, [], name='phase_train')
+        x = tf.layers.conv2d(images, 16, 5, strides=4, activation=tf.nn.relu)
+        x = tf.layers.conv2d(x, 32, 3, strides=2, activation=tf.nn.relu)
+        x = tf.layers.dense(tf.reduce_mean(x, axis=[1, 2]), 512)
+        # phase_train has to reach the output, or freezing prunes it and the encoder's input_map can't find it
+        x += 0.0 * tf.cast(phase_train, tf.float32)
+        tf.nn.l2_normalize(x, axis=1, name='embeddings')
+        with tf.Session(graph=graph) as sess:
+            sess.run(tf.global_variables_initializer())
+            frozen = tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), ['embeddings'])
+    with open(path, 'wb') as f:
+        f.write(frozen.SerializeToString())
+
+def write_reference_images(src_dir, count, size, seed=0):
+    rnd = np.random.RandomState(seed)
+    os.makedirs(src_dir, exist_ok=True)
+    for i in range(count):
+        # Smooth random images (upsampled noise), so the losses have some structure to fit
+        small = rnd.randint(0, 256, size=(size // 8, size // 8, 3), dtype=np.uint8)
+        PIL.Image.fromarray(small, 'RGB').resize((size, size), PIL.Image.BICUBIC).save(os.path.join(src_dir, 'ref%04d.png' % i))
+
+def run_config(config, work_dir):
+    # One benchmark configuration, in its own process: runs encode_images.run_encoder with the stage profiler on and
+    # returns the config with the profiler's stage timings
+    import tensorflow as tf
+    from encode_images import add_encoder_arguments, prepare_encoder_arguments, run_encoder, save_outputs
+    from encoder.profiler import Profiler
+
+    flags = ['--model_url', os.path.join(work_dir, 'tiny_stylegan.pkl'), '--model_res', str(config['resolution']),
+             '--image_size', str(config['resolution']), '--batch_size', str(config['batch_size']),
+             '--iterations', str(config['iterations']), '--steps_per_call', str(config['steps_per_call']),
+             '--fn_model_path', os.path.join(work_dir, 'standin_facenet.pb'),
+             '--data_dir', os.path.join(work_dir, 'data'), '--mask_dir', os.path.join(work_dir, 'masks'),
+             '--load_resnet', '', '--load_effnet', '', '--output_video', '',
+             '--profile_dir', os.path.join(work_dir, 'profile', '%d' % os.getpid()), '--profile_trace_every', '0',
+             '--use_fn_loss', '0', '--use_pixel_loss', '0', '--use_mssim_loss', '0', '--use_l1_penalty', '0']
+    for loss in config['losses'].split('+'):
+        flags += LOSSES[loss]
+    parser = argparse.ArgumentParser()
+    add_encoder_arguments(parser)
+    args = parser.parse_args(flags)
+    prepare_encoder_arguments(args)
+    args.generated_images_dir = os.path.join(work_dir, 'generated', '%d' % os.getpid())
+    args.dlatent_dir = os.path.join(work_dir, 'latent', '%d' % os.getpid())
+    for d in [args.data_dir, args.mask_dir, args.generated_images_dir, args.dlatent_dir]:
+        os.makedirs(d, exist_ok=True)
+
+    ref_images = sorted(os.path.join(work_dir, 'src', x) for x in os.listdir(os.path.join(work_dir, 'src')))
+    profiler = Profiler(enabled=True, trace_every=args.profile_trace_every)
+    def save_result(name, dlatent, img_array, loss):
+        save_outputs(args, name, dlatent, img_array)
+    start = time.perf_counter()
+    run_encoder(args, ref_images, save_result, profiler=profiler)
+    total = time.perf_counter() - start
+    profiler.save(args.profile_dir)
+
+    # Steps are counted from the profiled session runs; prepare_encoder_arguments may have lowered steps_per_call
+    steps = profiler.counts['step'] * args.steps_per_call
+    result = dict(config)
+    result.update(timings=dict(profiler.totals), counts=dict(profiler.counts), end_to_end=total, images=len(ref_images),
+                  steps=steps, steps_per_sec=steps / profiler.totals['step'], images_per_sec=len(ref_images) / total,
+                  profile_dir=args.profile_dir, tensorflow=tf.__version__)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the encoder on a tiny random StyleGAN', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--batch_sizes', default='1,4', help='Comma-separated batch sizes')
+    parser.add_argument('--losses', default='pixel,pixel+mssim,pixel+fn,pixel+mssim+fn+l1', help='Comma-separated loss combinations (pixel, mssim, fn, l1 joined with +)')
+    parser.add_argument('--steps_per_call', default='1', help='Comma-separated steps per session call')
+    parser.add_argument('--resolution', default=64, help='Resolution of the tiny StyleGAN', type=int)
+    parser.add_argument('--fmap_max', default=64, help='Maximum number of feature maps of the tiny StyleGAN', type=int)
+    parser.add_argument('--images', default=8, help='Number of reference images per configuration', type=int)
+    parser.add_argument('--iterations', default=20, help='Optimization steps per batch', type=int)
+    parser.add_argument('--work_dir', default='', help='Directory for the models and images; a temporary directory if empty')
+    parser.add_argument('--output', default='', help='Write the JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='encoder_benchmark_')
+    ctx = mp.get_context('spawn')
+    with ctx.Pool(1) as pool: # keep TF out of this process
+        pool.apply(build_tiny_stylegan, (os.path.join(work_dir, 'tiny_stylegan.pkl'), args.resolution, args.fmap_max))
+        pool.apply(build_standin_facenet, (os.path.join(work_dir, 'standin_facenet.pb'),))
+    write_reference_images(os.path.join(work_dir, 'src'), args.images, args.resolution)
+
+    configs = [dict(batch_size=int(batch_size), losses=losses, steps_per_call=int(steps_per_call),
+                    resolution=args.resolution, iterations=args.iterations)
+               for batch_size, losses, steps_per_call in itertools.product(args.batch_sizes.split(','), args.losses.split(','), args.steps_per_call.split(','))]
+    results = []
+    for config in configs:
+        with ctx.Pool(1, maxtasksperchild=1) as pool:
+            result = pool.apply(run_config, (config, work_dir))
+        print('batch %(batch_size)d, %(losses)s, %(steps_per_call)d steps/call: %(steps_per_sec).1f steps/s' % result, file=sys.stderr)
+        results.append(result)
+
+    report = dict(python=platform.python_version(), machine=platform.machine(), cpus=os.cpu_count(), results=results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Compare the fp16 and fp32 encoder on a tiny random StyleGAN: losses and dlatents after the same optimization steps,
+step time and peak memory, and whether overflowing fp16 steps are skipped.
+
+Both precisions run the encoder's own PerceptualModel step (dynamic loss scaling, Adam on float32 dlatents), each in
+a fresh process, from the same reference images and initial dlatents. Runs on CPU-only machines.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import multiprocessing as mp
+import numpy as np
+from benchmark_encoder import LOSSES, build_tiny_stylegan, build_standin_facenet, write_reference_images
+
+
+def traced_peak_bytes(sess, fetches):
+    import tensorflow as tf
+    from encoder.profiler import peak_bytes
+    run_metadata = tf.RunMetadata()
+    sess.run(fetches, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), run_metadata=run_metadata)
+    return peak_bytes(run_metadata)
+
+def run_precision(use_fp16, config, work_dir):
+    # One precision, in its own process: losses per step, final dlatents, step time, and (fp16) the overflow check
+    from encode_images import add_encoder_arguments, prepare_encoder_arguments, build_models
+
+    flags = ['--model_url', os.path.join(work_dir, 'tiny_stylegan.pkl'), '--model_res', str(config['resolution']),
+             '--image_size', str(config['resolution']), '--batch_size', str(config['batch_size']),
+             '--iterations', str(config['steps']), '--fn_model_path', os.path.join(work_dir, 'standin_facenet.pb'),
+             '--data_dir', os.path.join(work_dir, 'data'), '--mask_dir', os.path.join(work_dir, 'masks'),
+             '--load_resnet', '', '--load_effnet', '', '--output_video', '',
+             '--use_fn_loss', '0', '--use_pixel_loss', '0', '--use_mssim_loss', '0', '--use_l1_penalty', '0']
+    for loss in config['losses'].split('+'):
+        flags += LOSSES[loss]
+    if use_fp16:
+        flags += ['--use_fp16', 'True']
+    parser = argparse.ArgumentParser()
+    add_encoder_arguments(parser)
+    args = parser.parse_args(flags)
+    prepare_encoder_arguments(args)
+
+    generator, perceptual_model, cache, load_batch, predict_dlatents = build_models(args)
+    sess = perceptual_model.sess
+    fetch_ops = perceptual_model.get_fetch_ops(generator.dlatent_variable)
+    ref_images = sorted(os.path.join(work_dir, 'src', x) for x in os.listdir(os.path.join(work_dir, 'src')))
+    loaded_images, _ = load_batch(ref_images)
+    perceptual_model.set_reference_images(ref_images, loaded_image=loaded_images)
+    perceptual_model.reset()
+    generator.set_dlatents(np.load(os.path.join(work_dir, 'initial_dlatents.npy')))
+    perceptual_model.set_active(np.ones(args.batch_size))
+
+    losses, seconds = [], []
+    for _ in range(config['steps']):
+        start = time.perf_counter()
+        _, loss, _, _ = sess.run(fetch_ops)
+        seconds.append(time.perf_counter() - start)
+        losses.append(float(loss))
+    result = dict(losses=losses, dlatents=generator.get_dlatents(), best_loss=perceptual_model.get_best_loss(),
+                  step_seconds=float(np.median(seconds[1:] or seconds)))
+    result['peak_bytes'] = traced_peak_bytes(sess, fetch_ops)
+
+    if use_fp16:
+        # Force an overflow: with a 2**200 loss scale the scaled fp16 gradients are not finite, so the step has to
+        # leave the dlatents alone and lower the scale by loss_scaling_dec
+        loss_scaling = perceptual_model.loss_scaling
+        ls_var = loss_scaling.get_loss_scaling_var(perceptual_model.loss.device)
+        result['loss_scale_log2'] = float(sess.run(ls_var))
+        ls_var.load(200.0, sess)
+        before = generator.get_dlatents()
+        sess.run(fetch_ops)
+        result['overflow_step_skipped'] = bool(np.array_equal(before, generator.get_dlatents()))
+        result['overflow_scale_lowered'] = bool(np.isclose(sess.run(ls_var), 200.0 - loss_scaling.loss_scaling_dec))
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the fp16 and fp32 encoder steps on a tiny random StyleGAN', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--batch_size', default=2, help='Batch size', type=int)
+    parser.add_argument('--losses', default='pixel+l1', help='Loss combination (pixel, mssim, fn, l1 joined with +)')
+    parser.add_argument('--steps', default=50, help='Optimization steps per precision', type=int)
+    parser.add_argument('--resolution', default=64, help='Resolution of the tiny StyleGAN', type=int)
+    parser.add_argument('--fmap_max', default=64, help='Maximum number of feature maps of the tiny StyleGAN', type=int)
+    parser.add_argument('--seed', default=0, help='Random seed for the initial dlatents', type=int)
+    parser.add_argument('--work_dir', default='', help='Directory for the models and images; a temporary directory if empty')
+    parser.add_argument('--output', default='', help='Also write the JSON results here')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='fp16_benchmark_')
+    ctx = mp.get_context('spawn')
+    with ctx.Pool(1) as pool: # keep TF out of this process
+        pool.apply(build_tiny_stylegan, (os.path.join(work_dir, 'tiny_stylegan.pkl'), args.resolution, args.fmap_max))
+        pool.apply(build_standin_facenet, (os.path.join(work_dir, 'standin_facenet.pb'),))
+    write_reference_images(os.path.join(work_dir, 'src'), args.batch_size, args.resolution)
+    num_layers = int(2 * np.log2(args.resolution) - 2)
+    rnd = np.random.RandomState(args.seed)
+    initial = 0.5 * rnd.randn(args.batch_size, num_layers, 512).astype(np.float32)
+    np.save(os.path.join(work_dir, 'initial_dlatents.npy'), initial)
+
+    config = dict(batch_size=args.batch_size, losses=args.losses, steps=args.steps, resolution=args.resolution)
+    results = {}
+    for name, use_fp16 in [('fp32', False), ('fp16', True)]:
+        with ctx.Pool(1, maxtasksperchild=1) as pool:
+            results[name] = pool.apply(run_precision, (use_fp16, config, work_dir))
+
+    fp32, fp16 = results['fp32'], results['fp16']
+    loss_rel_error = np.abs(np.array(fp16['losses']) - fp32['losses']) / np.maximum(np.abs(fp32['losses']), 1e-12)
+    delta32, delta16 = fp32['dlatents'] - initial, fp16['dlatents'] - initial
+    report = dict(config,
+                  final_loss=dict(fp32=fp32['losses'][-1], fp16=fp16['losses'][-1]),
+                  max_loss_rel_error=float(np.max(loss_rel_error)),
+                  dlatent_rel_error=float(np.linalg.norm(fp16['dlatents'] - fp32['dlatents']) / (np.linalg.norm(fp32['dlatents']) + 1e-12)),
+                  dlatent_update_cosine=float(np.sum(delta16 * delta32) / (np.linalg.norm(delta16) * np.linalg.norm(delta32) + 1e-12)),
+                  step_ms=dict(fp32=1000 * fp32['step_seconds'], fp16=1000 * fp16['step_seconds']),
+                  peak_mb=dict(fp32=fp32['peak_bytes'] / 2**20, fp16=fp16['peak_bytes'] / 2**20),
+                  fp16_speedup=fp32['step_seconds'] / fp16['step_seconds'],
+                  loss_scale_log2=fp16['loss_scale_log2'],
+                  overflow_step_skipped=fp16['overflow_step_skipped'],
+                  overflow_scale_lowered=fp16['overflow_scale_lowered'])
+
+    print('Final loss fp32: %.6f, fp16: %.6f (max relative difference over %d steps: %.2e)'
+          % (report['final_loss']['fp32'], report['final_loss']['fp16'], args.steps, report['max_loss_rel_error']))
+    print('Dlatents relative error: %.2e, cosine of the dlatent updates: %.6f' % (report['dlatent_rel_error'], report['dlatent_update_cosine']))
+    print('%-6s %12s %14s' % ('', 'step (ms)', 'peak mem (MB)'))
+    for name in ['fp32', 'fp16']:
+        print('%-6s %12.1f %14.1f' % (name, report['step_ms'][name], report['peak_mb'][name]))
+    print('fp16 speedup: %.2fx, loss scale 2**%g after %d steps' % (report['fp16_speedup'], report['loss_scale_log2'], args.steps))
+    print('Overflow step skipped: %s, loss scale lowered: %s' % (report['overflow_step_skipped'], report['overflow_scale_lowered']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if not (report['overflow_step_skipped'] and report['overflow_scale_lowered']):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,252 @@
 import os
 import argparse
 import pickle
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 import PIL.Image
 import numpy as np
 import dnnlib
 import dnnlib.tflib as tflib
 import config
-from encoder.generator_model import Generator
+from encoder.generator_model import Generator, use_local_synthesis_source
+from encoder.convergence import ConvergenceMonitor
+from encoder.scheduler import SlotScheduler
+from encoder.cache import ReferenceCache, cached_rows
+from encoder.video_writer import AsyncVideoWriter
+from encoder.replicas import encode_replicas
+from encoder.profiler import Profiler
+from encoder.face_masks import MaskPrecomputer
 from encoder.percmod_oneiro import PerceptualModel, load_images
 from keras.models import load_model
 
 def split_to_batches(l, n):
-    for i in range(0, len(l), n):
-        yield l[i:i + n]
+    # Works on lists as well as on streams of paths (e.g. a replica's job queue)
+    l = iter(l)
+    batch = list(itertools.islice(l, n))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(l, n))
 
-def main():
-    parser = argparse.ArgumentParser(description='Find latent representation of reference images using perceptual losses', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('src_dir', help='Directory with images for encoding')
-    parser.add_argument('generated_images_dir', help='Directory for storing generated images')
-    parser.add_argument('dlatent_dir', help='Directory for storing dlatent representations')
+def parse_size_schedule(spec, iterations):
+    # "128:30,256:60" -> 128px for the first 30% of iterations, then 256px until 60%, then full size
+    levels = []
+    for level in filter(None, spec.split(',')):
+        size, percent = level.split(':')
+        levels.append((int(size), int(float(percent) * 0.01 * iterations)))
+    return sorted(levels, key=lambda level: level[1])
+
+def encode_continuous(args, paths, generator, perceptual_model, monitor, load_batch, predict_dlatents, prefetch, save_result):
+    # Continuous batching: every slot is refilled with the next image as soon as its current image is done
+    def jobs():
+        paths_iter = iter(paths)
+        pending = deque((path, prefetch.submit(load_batch, [path])) for path in itertools.islice(paths_iter, 2 * args.batch_size))
+        while pending:
+            path, future = pending.popleft()
+            next_path = next(paths_iter, None)
+            if next_path is not None:
+                pending.append((next_path, prefetch.submit(load_batch, [next_path])))
+            loaded_images, ff_images = future.result()
+            name = os.path.splitext(os.path.basename(path))[0]
+            dlatent = None
+            if (args.load_last != ''): # load previous dlatents for initialization
+                dlatent = np.load(os.path.join(args.load_last, f'{name}.npy'))
+            elif (predict_dlatents is not None): # predict initial dlatents with ResNet model
+                dlatent = predict_dlatents([path], ff_images)[0]
+            yield name, path, loaded_images[0], dlatent
+
+    def on_finished(name, dlatent, img_array, loss):
+        print(name, " Loss {:.4f}".format(loss))
+        with perceptual_model.profiler.stage('output_save'):
+            save_result(name, dlatent, img_array, loss)
+
+    scheduler = SlotScheduler(generator, perceptual_model, monitor=monitor, iterations=args.iterations)
+    scheduler.run(jobs(), on_finished)
+
+def encode_batches(args, batches, generator, perceptual_model, monitor, load_batch, predict_dlatents, prefetch, save_result):
+    profiler = perceptual_model.profiler
+    with profiler.stage('optimizer_build'):
+        fetch_ops = perceptual_model.get_fetch_ops(generator.dlatent_variable)
+    early_stop = args.early_stop_window > 0 or args.early_stop_loss > 0
+    if args.output_video:
+        video_writer = AsyncVideoWriter(codec=args.video_codec, frame_rate=args.video_frame_rate, size=args.video_size, profiler=profiler)
+        video_frames = perceptual_model.video_frames
+
+    # Optimize (only) dlatents by minimizing perceptual loss between reference and generated images in feature space
+    batches = iter(batches)
+    images_batch = next(batches, None)
+    if images_batch is not None:
+        next_batch = prefetch.submit(load_batch, images_batch)
+    while images_batch is not None:
+        loaded_images, ff_images = next_batch.result()
+        following_batch = next(batches, None)
+        if following_batch is not None:
+            next_batch = prefetch.submit(load_batch, following_batch)
+
+        names = [os.path.splitext(os.path.basename(x))[0] for x in images_batch]
+        if args.output_video:
+            for name in names:
+                video_writer.open(name, os.path.join(args.video_dir, f'{name}.avi'))
+
+        perceptual_model.set_reference_images(images_batch, loaded_image=loaded_images)
+        perceptual_model.reset()
+        if (args.load_last != ''): # load previous dlatents for initialization
+            generator.set_dlatents_many([np.load(os.path.join(args.load_last, f'{name}.npy')) for name in names])
+        elif (predict_dlatents is not None): # predict initial dlatents with ResNet model
+            generator.set_dlatents_many(predict_dlatents(images_batch, ff_images))
+
+        # Padding slots of a partial batch are not optimized
+        perceptual_model.set_active(np.arange(args.batch_size) < len(names))
+        monitor.reset()
+
+        vid_count = 0
+        for idx_iter in range(0, args.iterations, args.steps_per_call):
+            if args.output_video and (vid_count % args.video_skip == 0):
+                # Video frames come out of the same run as the optimization step, already resized on the device
+                _, loss, lr, loss_per_image, batch_frames = profiler.run(perceptual_model.sess, fetch_ops + [video_frames])
+                video_writer.write(names, batch_frames)
+            else:
+                _, loss, lr, loss_per_image = profiler.run(perceptual_model.sess, fetch_ops)
+            vid_count += 1
+            if early_stop:
+                if monitor.update(loss_per_image).any():
+                    perceptual_model.set_active(~monitor.converged & (np.arange(args.batch_size) < len(names)))
+                if monitor.all_converged(len(names)):
+                    break
+        best_loss = perceptual_model.get_best_loss()
+        print(" ".join(names), " Loss " + " ".join("{:.4f}".format(l) for l in best_loss[:len(names)]))
+
+        if args.output_video:
+            video_writer.release(names)
+
+        # Generate images from found dlatents and save them
+        with profiler.stage('results_fetch'):
+            generator.set_dlatents(perceptual_model.get_best_dlatents())
+            generated_images = generator.generate_images()
+            generated_dlatents = generator.get_dlatents()
+        with profiler.stage('output_save'):
+            for img_array, dlatent, img_name, img_loss in zip(generated_images, generated_dlatents, names, best_loss):
+                save_result(img_name, dlatent, img_array, img_loss)
+        images_batch = following_batch
+    if args.output_video:
+        video_writer.close()
+
+def uncached_masks(args, cache, images_list):
+    # Images whose face mask isn't in the reference cache (the key PerceptualModel looks masks up with)
+    if cache is None:
+        return images_list
+    return [x for x in images_list if cache.key(x, 'face_mask', args.image_size, args.use_grabcut, args.scale_mask) not in cache]
+
+def build_models(args, tf_config=None, profiler=None):
+    # Generator, perceptual model, reference cache and the batch loading / initial dlatent helpers
+    tflib.init_tf(tf_config)
+    if args.truncated_synthesis:
+        use_local_synthesis_source()
+    with open(args.model_url, 'rb') as fp:
+        Gs_network = pickle.load(fp)
+
+    generator = Generator(Gs_network, args.batch_size, tiled_dlatent=args.tile_dlatents, model_res=args.model_res, randomize_noise=args.randomize_noise,
+                          dtype='float16' if args.use_fp16 else 'float32')
+    if (args.dlatent_avg != ''):
+        generator.set_dlatent_avg(np.load(args.dlatent_avg))
+
+    perc_model = None
+    if (args.use_lpips_loss > 0.00000001):
+        with dnnlib.util.open_url('https://drive.google.com/uc?id=1N2-m9qszOeVC9Tq77WxsLnuWwOedQiD2', cache_dir=config.cache_dir) as f:
+            perc_model =  pickle.load(f)
+    cache = None
+    if (args.cache_dir != ''):
+        cache = ReferenceCache(args.cache_dir, max_bytes=args.cache_size << 20)
+    perceptual_model = PerceptualModel(args, perc_model=perc_model, batch_size=args.batch_size, cache=cache, profiler=profiler)
+    perceptual_model.build_perceptual_model(generator)
+    profiler = perceptual_model.profiler
+    if args.face_mask and args.mask_workers > 0:
+        perceptual_model.mask_precomputer = MaskPrecomputer(args.mask_dir, args.image_size, args.use_grabcut, args.scale_mask,
+                                                            workers=args.mask_workers, predictor_path=perceptual_model.landmarks_model_path)
+
+    ff_model = None
+    if (args.load_last == ''):
+        if os.path.exists(args.load_resnet):
+            print("Loading ResNet Model:")
+            ff_model = load_model(args.load_resnet)
+            ff_model_path = args.load_resnet
+            from keras.applications.resnet50 import preprocess_input
+        if (ff_model is None):
+            if os.path.exists(args.load_effnet):
+                import efficientnet
+                print("Loading EfficientNet Model:")
+                ff_model = load_model(args.load_effnet)
+                ff_model_path = args.load_effnet
+                from efficientnet import preprocess_input
+
+    def load_batch(images_batch):
+        # Runs on the prefetch thread, so decoding the next batch overlaps with optimizing the current one
+        if perceptual_model.mask_precomputer is not None:
+            # Cache hits never wait for their mask future, so only the misses are sent to the mask workers
+            perceptual_model.mask_precomputer.submit(uncached_masks(args, cache, images_batch))
+        with profiler.stage('image_load'):
+            loaded_images = cached_rows(cache, images_batch, 'ref_img', (args.image_size,),
+                                        lambda idx: load_images([images_batch[i] for i in idx], args.image_size))
+            ff_images = {}
+            if (ff_model is not None):
+                # Only images whose initial dlatents aren't cached yet need the ResNet input
+                missing = [x for x in images_batch if cache is None or cache.key(x, 'ff_dlatents', *ff_params) not in cache]
+                if missing:
+                    ff_images = dict(zip(missing, load_images(missing, image_size=args.resnet_image_size)))
+        return loaded_images, ff_images
+
+    predict_dlatents = None
+    if (ff_model is not None):
+        ff_params = (args.resnet_image_size, ff_model_path)
+        def predict_dlatents(images_batch, ff_images):
+            def predict(idx):
+                paths = [images_batch[i] for i in idx]
+                images = [ff_images[x] if x in ff_images else load_images([x], image_size=args.resnet_image_size)[0] for x in paths]
+                return ff_model.predict(preprocess_input(np.stack(images)))
+            with profiler.stage('dlatent_prediction'):
+                return cached_rows(cache, images_batch, 'ff_dlatents', ff_params, predict)
+
+    return generator, perceptual_model, cache, load_batch, predict_dlatents
+
+def run_encoder(args, paths, save_result, tf_config=None, profiler=None):
+    # Build the models and encode paths (a list or a stream), calling save_result(name, dlatent, image, loss) per image
+    # Without a profiler from the caller (e.g. in a replica process), --profile_dir profiles this run on its own
+    own_profiler = profiler is None
+    if own_profiler:
+        profiler = Profiler(enabled=args.profile_dir != '', trace_every=args.profile_trace_every)
+    with profiler.stage('model_build'):
+        generator, perceptual_model, cache, load_batch, predict_dlatents = build_models(args, tf_config, profiler)
+    early_stop = args.early_stop_window > 0 or args.early_stop_loss > 0
+    monitor = ConvergenceMonitor(args.batch_size, window=args.early_stop_window, rel_tol=args.early_stop_rel_tol,
+                                 target_loss=args.early_stop_loss if args.early_stop_loss > 0 else None)
+
+    if perceptual_model.mask_precomputer is not None and isinstance(paths, list):
+        # Face masks for the whole run are generated ahead of the optimizer on the mask workers
+        perceptual_model.mask_precomputer.submit(uncached_masks(args, cache, paths))
+    prefetch = ThreadPoolExecutor(max_workers=1)
+    if args.continuous:
+        encode_continuous(args, paths, generator, perceptual_model, monitor if early_stop else None, load_batch, predict_dlatents, prefetch, save_result)
+    else:
+        encode_batches(args, split_to_batches(paths, args.batch_size), generator, perceptual_model, monitor, load_batch, predict_dlatents, prefetch, save_result)
+    prefetch.shutdown()
+    if perceptual_model.mask_precomputer is not None:
+        perceptual_model.mask_precomputer.close()
+    if cache is not None:
+        cache.close()
+    if own_profiler and profiler.enabled:
+        profiler.save(args.profile_dir)
+
+def save_outputs(args, name, dlatent, img_array):
+    PIL.Image.fromarray(img_array, 'RGB').save(os.path.join(args.generated_images_dir, f'{name}.png'), 'PNG')
+    np.save(os.path.join(args.dlatent_dir, f'{name}.npy'), dlatent)
+
+def add_encoder_arguments(parser):
+    # Model, loss and optimizer options, shared by encode_images.py and encode_server.py
     parser.add_argument('--data_dir', default='data', help='Directory for storing optional models')
     parser.add_argument('--mask_dir', default='masks', help='Directory for storing optional masks')
+    parser.add_argument('--cache_dir', default='', help='Directory for caching reference images, masks, embeddings and initial dlatents; empty to disable')
+    parser.add_argument('--cache_size', default=4096, help='Maximum size of the cache in MB', type=int)
     parser.add_argument('--load_last', default='', help='Start with embeddings from directory')
     parser.add_argument('--dlatent_avg', default='', help='Use dlatent from file specified here for truncation instead of dlatent_avg from Gs')
     parser.add_argument('--model_url', default='https://drive.google.com/uc?id=1MEGjdvVpUsu1jB4zrXZN7Y4kBBOzizDQ', help='Fetch a StyleGAN model to train on from this URL') # karras2019stylegan-ffhq-1024x1024.pkl
@@ -34,7 +259,17 @@ def main():
     parser.add_argument('--lr', default=0.02, help='Learning rate for perceptual model', type=float)
     parser.add_argument('--decay_rate', default=0.9, help='Decay rate for learning rate', type=float)
     parser.add_argument('--iterations', default=500, help='Number of optimization steps for each batch', type=int)
+    parser.add_argument('--early_stop_window', default=0, help='Stop optimizing an image once its best loss improved less than early_stop_rel_tol over this many steps; 0 to disable', type=int)
+    parser.add_argument('--early_stop_rel_tol', default=0.001, help='Relative loss improvement over early_stop_window below which an image has converged', type=float)
+    parser.add_argument('--early_stop_loss', default=0, help='Stop optimizing an image once its loss is below this value; 0 to disable', type=float)
+    parser.add_argument('--continuous', default=False, help='Refill each batch slot with the next image as soon as its current image is done', type=bool)
+    parser.add_argument('--replicas', default=1, help='Number of encoder processes sharing the input images (data-parallel encoding)', type=int)
+    parser.add_argument('--replica_devices', default='', help='Comma-separated GPU ids, one per replica (round robin); empty to run the replicas on CPU cores')
+    parser.add_argument('--replica_threads', default=0, help='Intra-op threads per CPU replica; 0 to split the available cores evenly', type=int)
+    parser.add_argument('--steps_per_call', default=1, help='Optimization steps to run on the device per session call (rounds iterations up to a multiple; not with --use_fn_loss)', type=int)
     parser.add_argument('--decay_steps', default=10, help='Decay steps for learning rate decay (as a percent of iterations)', type=float)
+    parser.add_argument('--loss_pyramid', default='', help='Coarse-to-fine image losses as size:percent pairs, e.g. 128:30,256:60 (percent of iterations at each size)')
+    parser.add_argument('--truncated_synthesis', default='', help='Stop the synthesis network early as resolution:percent pairs, e.g. 256:40,512:70 (percent of iterations at each resolution)')
     parser.add_argument('--load_effnet', default='data/finetuned_effnet.h5', help='Model to load for EfficientNet approximation of dlatents')
     parser.add_argument('--load_resnet', default='data/finetuned_resnet.h5', help='Model to load for ResNet approximation of dlatents')
     parser.add_argument('--fn_model_path', default='data/20180408-102900.pb', help='Model FN')
@@ -49,14 +284,17 @@ def main():
 
     # Generator params
     parser.add_argument('--randomize_noise', default=False, help='Add noise to dlatents during optimization', type=bool)
+    parser.add_argument('--use_fp16', default=False, help='Run the synthesis network in float16, with dynamic loss scaling', type=bool)
     parser.add_argument('--tile_dlatents', default=False, help='Tile dlatents to use a single vector at each scale', type=bool)
     parser.add_argument('--clipping_threshold', default=2.0, help='Stochastic clipping of gradient values outside of this threshold', type=float)
+    parser.add_argument('--stochastic_clip', default=False, help='Apply stochastic clipping to dlatents after each optimization step', type=bool)
 
     # Masking params
     parser.add_argument('--load_mask', default=False, help='Load segmentation masks', type=bool)
     parser.add_argument('--face_mask', default=False, help='Generate a mask for predicting only the face area', type=bool)
     parser.add_argument('--use_grabcut', default=True, help='Use grabcut algorithm on the face mask to better segment the foreground', type=bool)
     parser.add_argument('--scale_mask', default=1.5, help='Look over a wider section of foreground for grabcut', type=float)
+    parser.add_argument('--mask_workers', default=0, help='Generate face masks ahead of the optimizer in this many processes; 0 to generate them in the main process', type=int)
 
     # Video params
     parser.add_argument('--video_dir', default='videos', help='Directory for storing training videos')
@@ -66,13 +304,40 @@ def main():
     parser.add_argument('--video_size', default=256, help='Video size in pixels', type=int)
     parser.add_argument('--video_skip', default=1, help='Only write every n frames (1 = write every frame)', type=int)
 
-    args, other_args = parser.parse_known_args()
+    # Profiling params
+    parser.add_argument('--profile_dir', default='', help='Write a Chrome trace and a per-stage timing summary here; empty to disable profiling')
+    parser.add_argument('--profile_trace_every', default=100, help='Collect TF step stats every n optimization calls when profiling; 0 to disable', type=int)
 
+def prepare_encoder_arguments(args):
     args.decay_steps *= 0.01 * args.iterations # Calculate steps as a percent of total iterations
+    args.loss_pyramid = parse_size_schedule(args.loss_pyramid, args.iterations)
+    args.truncated_synthesis = parse_size_schedule(args.truncated_synthesis, args.iterations)
+    if args.steps_per_call > 1 and args.use_fn_loss > 0.00000001:
+        # The frozen FaceNet graph has batch norm conds on phase_train, which can't be differentiated inside the
+        # tf.while_loop of the fused steps
+        print("--steps_per_call is not supported with --use_fn_loss, running one step per call")
+        args.steps_per_call = 1
 
-    if args.output_video:
-      import cv2
-      synthesis_kwargs = dict(output_transform=dict(func=tflib.convert_images_to_uint8, nchw_to_nhwc=False), minibatch_size=args.batch_size)
+def check_continuous_arguments(args):
+    # Options that don't work with slots refilled mid-run
+    if args.continuous and args.output_video:
+        print("Videos are not supported with --continuous, disabling --output_video")
+        args.output_video = False
+    if args.continuous and (args.loss_pyramid or args.truncated_synthesis):
+        # Both follow global_step, which only restarts with a new run, so refilled slots would skip the coarse levels
+        print("--loss_pyramid and --truncated_synthesis are not supported with --continuous, disabling them")
+        args.loss_pyramid = []
+        args.truncated_synthesis = []
+
+def main():
+    parser = argparse.ArgumentParser(description='Find latent representation of reference images using perceptual losses', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('src_dir', help='Directory with images for encoding')
+    parser.add_argument('generated_images_dir', help='Directory for storing generated images')
+    parser.add_argument('dlatent_dir', help='Directory for storing dlatent representations')
+    add_encoder_arguments(parser)
+    args, other_args = parser.parse_known_args()
+    prepare_encoder_arguments(args)
+    check_continuous_arguments(args)
 
     ref_images = [os.path.join(args.src_dir, x) for x in os.listdir(args.src_dir)]
     ref_images = list(filter(os.path.isfile, ref_images))
@@ -86,116 +351,25 @@ def main():
     os.makedirs(args.dlatent_dir, exist_ok=True)
     os.makedirs(args.video_dir, exist_ok=True)
 
-    # Initialize generator and perceptual model
-    tflib.init_tf()
-    with open(args.model_url, 'rb') as fp:
-        Gs_network = pickle.load(fp)
-
-    generator = Generator(Gs_network, args.batch_size, tiled_dlatent=args.tile_dlatents, model_res=args.model_res, randomize_noise=args.randomize_noise)
-    if (args.dlatent_avg != ''):
-        generator.set_dlatent_avg(np.load(args.dlatent_avg))
-
-    perc_model = None
-    if (args.use_lpips_loss > 0.00000001):
-        with dnnlib.util.open_url('https://drive.google.com/uc?id=1N2-m9qszOeVC9Tq77WxsLnuWwOedQiD2', cache_dir=config.cache_dir) as f:
-            perc_model =  pickle.load(f)
-    perceptual_model = PerceptualModel(args, perc_model=perc_model, batch_size=args.batch_size)
-    perceptual_model.build_perceptual_model(generator)
+    # With --replicas this process profiles the output saving; every replica saves its own profile to profile_dir/replica<N>
+    profiler = Profiler(enabled=args.profile_dir != '', trace_every=args.profile_trace_every)
+    progress = tqdm(total=len(ref_images))
+    def save_result(name, dlatent, img_array, loss):
+        save_outputs(args, name, dlatent, img_array)
+        progress.update(1)
 
-    ff_model = None
-
-    # Optimize (only) dlatents by minimizing perceptual loss between reference and generated images in feature space
-
-    images_batch = ref_images
-    names = [os.path.splitext(os.path.basename(x))[0] for x in images_batch]
-    if args.output_video:
-      video_out = {}
-      for name in names:
-        video_out[name] = cv2.VideoWriter(os.path.join(args.video_dir, f'{name}.avi'),cv2.VideoWriter_fourcc(*args.video_codec), args.video_frame_rate, (args.video_size,args.video_size))
-
-    perceptual_model.set_reference_images(images_batch)
-    dlatents = None
-    if (args.load_last != ''): # load previous dlatents for initialization
-        for name in names:
-            dl = np.expand_dims(np.load(os.path.join(args.load_last, f'{name}.npy')),axis=0)
-            if (dlatents is None):
-                dlatents = dl
-            else:
-                dlatents = np.vstack((dlatents,dl))
+    if args.replicas > 1:
+        # Every replica is a process with its own session, models and optimizer, pulling images from a queue;
+        # all outputs are written here
+        def save_replica_result(*result):
+            with profiler.stage('output_save'):
+                save_result(*result)
+        encode_replicas(args, ref_images, run_encoder, save_replica_result, devices=args.replica_devices, threads=args.replica_threads)
     else:
-        if (ff_model is None):
-            if os.path.exists(args.load_resnet):
-                print("Loading ResNet Model:")
-                ff_model = load_model(args.load_resnet)
-                from keras.applications.resnet50 import preprocess_input
-        if (ff_model is None):
-            if os.path.exists(args.load_effnet):
-                import efficientnet
-                print("Loading EfficientNet Model:")
-                ff_model = load_model(args.load_effnet)
-                from efficientnet import preprocess_input
-        if (ff_model is not None): # predict initial dlatents with ResNet model
-            dlatents = ff_model.predict(preprocess_input(load_images(images_batch,image_size=args.resnet_image_size)))
-    if dlatents is not None:
-        generator.set_dlatents(dlatents)
-
-    fetch_ops = perceptual_model.get_fetch_ops(generator.dlatent_variable)
-    vid_count = 0
-    best_loss = None
-    best_dlatent = None
-    for idx_iter in range(args.iterations):
-        res = perceptual_model.sess.run(fetch_ops)
-        _, loss, lr = res
-        if best_loss is None or loss < best_loss:
-            best_loss = loss
-            best_dlatent = generator.get_dlatents()
-        if args.output_video and (vid_count % args.video_skip == 0):
-            batch_frames = generator.generate_images()
-            for i, name in enumerate(names):
-                video_frame = PIL.Image.fromarray(batch_frames[i], 'RGB').resize((args.video_size, args.video_size),
-                                                                                 PIL.Image.LANCZOS)
-                video_out[name].write(cv2.cvtColor(np.array(video_frame).astype('uint8'), cv2.COLOR_RGB2BGR))
-
-    '''
-    op = perceptual_model.optimize(generator.dlatent_variable, iterations=args.iterations)
-    vid_count = 0
-    best_loss = None
-    best_dlatent = None
-    iternow=0
-    for loss_dict in op:
-        #descr = " ".join(names) + ": " + "; ".join(["{} {:.4f}".format(k, v) for k, v in loss_dict.items()])
-        print(loss_dict)
-        print(iternow)
-        iternow += 1
-        if best_loss is None or loss_dict["loss"] < best_loss:
-            best_loss = loss_dict["loss"]
-            best_dlatent = generator.get_dlatents()
-        if args.output_video and (vid_count % args.video_skip == 0):
-            batch_frames = generator.generate_images()
-            for i, name in enumerate(names):
-                video_frame = PIL.Image.fromarray(batch_frames[i], 'RGB').resize((args.video_size, args.video_size),
-                                                                                 PIL.Image.LANCZOS)
-                video_out[name].write(cv2.cvtColor(np.array(video_frame).astype('uint8'), cv2.COLOR_RGB2BGR))
-
-        #generator.stochastic_clip_dlatents()
-
-    #print(" ".join(names), " Loss {:.4f}".format(best_loss))
-    '''
-
-    if args.output_video:
-        for name in names:
-            video_out[name].release()
-
-    # Generate images from found dlatents and save them
-    generator.set_dlatents(best_dlatent)
-    generated_images = generator.generate_images()
-    generated_dlatents = generator.get_dlatents()
-    for img_array, dlatent, img_name in zip(generated_images, generated_dlatents, names):
-        img = PIL.Image.fromarray(img_array, 'RGB')
-        img.save(os.path.join(args.generated_images_dir, f'{img_name}.png'), 'PNG')
-        np.save(os.path.join(args.dlatent_dir, f'{img_name}.npy'), dlatent)
-
-    generator.reset_dlatents()
+        run_encoder(args, ref_images, save_result, profiler=profiler)
+    progress.close()
+    if profiler.enabled:
+        print(profiler.save(args.profile_dir))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,245 @@
+"""Long-running encoding server: loads the models once and encodes uploaded images over HTTP or a Unix socket.
+
+POST /encode with the image file as the request body (optional query parameters: name, iterations) answers with
+JSON {"name", "loss", "dlatent": base64 .npy, "image": base64 PNG}. Concurrent requests share the optimizer's batch
+slots (continuous batching), so a request starts as soon as a slot is free. GET /health reports the queue state.
+"""
+
+import os
+import io
+import json
+import queue
+import base64
+import hashlib
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import http.client
+import http.server
+import socketserver
+import urllib.parse
+import PIL.Image
+import numpy as np
+from encoder.scheduler import SlotScheduler
+from encoder.convergence import ConvergenceMonitor
+from encoder.face_masks import mask_path
+from encode_images import add_encoder_arguments, prepare_encoder_arguments, check_continuous_arguments, build_models
+
+
+class EncodeJob:
+    def __init__(self, name, path, iterations=None):
+        self.name = name
+        self.path = path
+        self.iterations = iterations
+        self.done = threading.Event()
+        self.result = None
+
+class EncodeServer:
+    """Owns the models and the session; every TF call happens on the thread running serve_jobs()."""
+    def __init__(self, args):
+        self.args = args
+        self.generator, self.perceptual_model, self.cache, self.load_batch, self.predict_dlatents = build_models(args)
+        monitor = None
+        if args.early_stop_window > 0 or args.early_stop_loss > 0:
+            monitor = ConvergenceMonitor(args.batch_size, window=args.early_stop_window, rel_tol=args.early_stop_rel_tol,
+                                         target_loss=args.early_stop_loss if args.early_stop_loss > 0 else None)
+        self.scheduler = SlotScheduler(self.generator, self.perceptual_model, monitor=monitor, iterations=args.iterations)
+        self.upload_dir = tempfile.mkdtemp(prefix='encode_server_')
+        self.queue = queue.Queue()
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.next_id = 0
+
+    def submit(self, image_bytes, name=None, iterations=None):
+        # Called from the request threads; blocks until the image is encoded or args.job_timeout seconds have passed
+        with self.lock:
+            job_id = '%08d' % self.next_id
+            self.next_id += 1
+        # Named by content, so concurrent uploads of the same image share one face mask in mask_dir
+        os.makedirs(os.path.join(self.upload_dir, job_id))
+        path = os.path.join(self.upload_dir, job_id, hashlib.sha1(image_bytes).hexdigest())
+        with open(path, 'wb') as f:
+            f.write(image_bytes)
+        job = EncodeJob(name or job_id, path, iterations)
+        with self.lock:
+            self.jobs[job_id] = job
+        self.queue.put(job_id)
+        if not job.done.wait(self.args.job_timeout if self.args.job_timeout > 0 else None):
+            # The job keeps its slot until it finishes; its files are removed then
+            return dict(name=job.name, error='not encoded within %g s' % self.args.job_timeout)
+        return job.result
+
+    def status(self):
+        with self.lock:
+            return dict(queued=self.queue.qsize(), busy=sum(slot is not None for slot in self.scheduler.slots),
+                        slots=self.args.batch_size)
+
+    def _prepare(self, job_id):
+        job = self.jobs[job_id]
+        try:
+            loaded_images, ff_images = self.load_batch([job.path])
+            dlatent = None
+            if self.predict_dlatents is not None:
+                dlatent = self.predict_dlatents([job.path], ff_images)[0]
+        except Exception as e:
+            self._fail(job_id, str(e))
+            return None
+        return job_id, job.path, loaded_images[0], dlatent, job.iterations
+
+    def _job_stream(self, first_job_id):
+        job = self._prepare(first_job_id)
+        while True:
+            if job is not None:
+                yield job
+            try:
+                job = self._prepare(self.queue.get_nowait())
+            except queue.Empty:
+                yield None
+                job = None
+
+    def _fail(self, job_id, error):
+        with self.lock:
+            job = self.jobs.pop(job_id)
+        job.result = dict(name=job.name, error=error)
+        self._remove_files(job)
+        job.done.set()
+
+    def _finish(self, job_id, dlatent, img_array, loss):
+        with self.lock:
+            job = self.jobs.pop(job_id)
+        png = io.BytesIO()
+        PIL.Image.fromarray(img_array, 'RGB').save(png, 'PNG')
+        npy = io.BytesIO()
+        np.save(npy, dlatent)
+        job.result = dict(name=job.name, loss=float(loss), dlatent=base64.b64encode(npy.getvalue()).decode('ascii'),
+                          image=base64.b64encode(png.getvalue()).decode('ascii'))
+        self._remove_files(job)
+        job.done.set()
+
+    def _remove_files(self, job):
+        # Uploads are never read again: remove the upload, its face mask and its file hash, so none of them pile up
+        if self.perceptual_model.mask_precomputer is not None:
+            self.perceptual_model.mask_precomputer.wait(job.path) # a mask still being generated would be written after
+        shutil.rmtree(os.path.dirname(job.path), ignore_errors=True)
+        mask = mask_path(self.args.mask_dir, job.path)
+        if os.path.isfile(mask):
+            os.remove(mask)
+        if self.cache is not None:
+            self.cache.forget(job.path)
+
+    def serve_jobs(self):
+        # Wait for a request while all slots are idle, then keep the slots busy until the queue runs dry again
+        while True:
+            self.scheduler.run(self._job_stream(self.queue.get()), self._finish)
+
+    def close(self):
+        shutil.rmtree(self.upload_dir, ignore_errors=True)
+        if self.cache is not None:
+            self.cache.close()
+
+def make_handler(server):
+    class EncodeHandler(http.server.BaseHTTPRequestHandler):
+        def address_string(self):
+            return self.client_address[0] if self.client_address else 'unix'
+
+        def _reply(self, code, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if urllib.parse.urlparse(self.path).path != '/health':
+                return self._reply(404, dict(error='not found'))
+            self._reply(200, dict(status='ok', **server.status()))
+
+        def do_POST(self):
+            url = urllib.parse.urlparse(self.path)
+            if url.path != '/encode':
+                return self._reply(404, dict(error='not found'))
+            query = urllib.parse.parse_qs(url.query)
+            image_bytes = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                PIL.Image.open(io.BytesIO(image_bytes)).verify()
+                iterations = int(query['iterations'][0]) if 'iterations' in query else None
+            except Exception as e:
+                return self._reply(400, dict(error=str(e)))
+            name = query['name'][0] if 'name' in query else None
+            result = server.submit(image_bytes, name=name, iterations=iterations)
+            self._reply(500 if 'error' in result else 200, result)
+    return EncodeHandler
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+def encode_request(image_path, host='localhost', port=8000, socket_path='', name=None, iterations=None, timeout=None):
+    """Local client: send one image to a running server, returns (dlatent, PIL image, loss)."""
+    conn = UnixHTTPConnection(socket_path, timeout=timeout) if socket_path else http.client.HTTPConnection(host, port, timeout=timeout)
+    query = {}
+    if name is not None:
+        query['name'] = name
+    if iterations is not None:
+        query['iterations'] = iterations
+    with open(image_path, 'rb') as f:
+        conn.request('POST', '/encode?' + urllib.parse.urlencode(query), body=f.read())
+    response = conn.getresponse()
+    body = json.loads(response.read().decode('utf-8'))
+    conn.close()
+    if response.status != 200:
+        raise RuntimeError('Encoding %s failed: %s' % (image_path, body.get('error')))
+    dlatent = np.load(io.BytesIO(base64.b64decode(body['dlatent'])))
+    image = PIL.Image.open(io.BytesIO(base64.b64decode(body['image'])))
+    return dlatent, image, body['loss']
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve image encoding requests with persistent models', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', default=8000, help='Port to listen on', type=int)
+    parser.add_argument('--socket', default='', help='Listen on this Unix socket instead of host:port')
+    parser.add_argument('--job_timeout', default=600, help='Answer a request with an error after this many seconds; 0 to wait forever', type=float)
+    add_encoder_arguments(parser)
+    args, other_args = parser.parse_known_args()
+    prepare_encoder_arguments(args)
+    args.continuous = True
+    args.output_video = False
+    check_continuous_arguments(args)
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    os.makedirs(args.mask_dir, exist_ok=True)
+    server = EncodeServer(args)
+    handler = make_handler(server)
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        httpd = ThreadingUnixHTTPServer(args.socket, handler)
+        print('Serving on %s' % args.socket)
+    else:
+        httpd = http.server.ThreadingHTTPServer((args.host, args.port), handler)
+        print('Serving on http://%s:%d' % (args.host, args.port))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    try:
+        server.serve_jobs()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.shutdown()
+        server.close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import os
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class ReferenceCache:
+    """On-disk cache of per-image arrays: resized reference images, face masks, FaceNet embeddings, initial dlatents.
+
+    Entries are keyed by the content hash of the source image plus the preprocessing parameters, and are stored in a
+    single memory-mapped data file of max_bytes. When it fills up, the least recently used entries are evicted until
+    the new entry fits in a free region. Data never moves, and the index is written (atomically) before a freed region
+    is reused, so after an unclean exit the index on disk can miss recent entries but never points at other data.
+    """
+    def __init__(self, cache_dir, max_bytes=4 << 30):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.data_path = os.path.join(cache_dir, 'cache.bin')
+        self.index_path = os.path.join(cache_dir, 'index.pkl')
+        self.max_bytes = int(max_bytes)
+        self.lock = threading.RLock()
+        self.entries = OrderedDict() # key -> (offset, nbytes, shape, dtype), least recently used first
+        self.file_hashes = {} # path -> (mtime, size, content hash)
+        if os.path.isfile(self.index_path) and os.path.isfile(self.data_path):
+            with open(self.index_path, 'rb') as f:
+                index = pickle.load(f)
+            self.entries, self.file_hashes = index['entries'], index['file_hashes']
+        if not os.path.isfile(self.data_path) or os.path.getsize(self.data_path) < self.max_bytes:
+            with open(self.data_path, 'ab') as f:
+                f.truncate(self.max_bytes) # sparse on most filesystems
+        self.data = np.memmap(self.data_path, dtype=np.uint8, mode='r+', shape=(self.max_bytes,))
+        # Entries past max_bytes are dropped if the cache was shrunk since the last run
+        self.entries = OrderedDict((k, v) for k, v in self.entries.items() if v[0] + v[1] <= self.max_bytes)
+        self.end = max([offset + nbytes for offset, nbytes, _, _ in self.entries.values()], default=0) # nothing is stored past end
+
+    def content_hash(self, path):
+        st = os.stat(path)
+        with self.lock:
+            cached = self.file_hashes.get(path)
+            if cached is not None and cached[:2] == (st.st_mtime, st.st_size):
+                return cached[2]
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        with self.lock:
+            self.file_hashes[path] = (st.st_mtime, st.st_size, h.hexdigest())
+        return h.hexdigest()
+
+    def forget(self, path):
+        # Drop the hash of a file that won't be read again (e.g. a deleted upload); its entries stay cached by content
+        with self.lock:
+            self.file_hashes.pop(path, None)
+
+    def key(self, path, kind, *params):
+        return '%s:%s:%r' % (self.content_hash(path), kind, params)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            offset, nbytes, shape, dtype = entry
+            return np.array(self.data[offset:offset + nbytes]).view(dtype).reshape(shape)
+
+    def put(self, key, value):
+        value = np.ascontiguousarray(value)
+        nbytes = value.nbytes
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            freed = self.entries.pop(key, None) is not None
+            offset = self.end if self.end + nbytes <= self.max_bytes else self._find_free(nbytes)
+            while offset is None:
+                self.entries.popitem(last=False)
+                freed = True
+                offset = self._find_free(nbytes)
+            if freed:
+                # The index on disk may still list the freed regions: replace it before any of them is overwritten
+                self.flush()
+            self.data[offset:offset + nbytes] = value.reshape(-1).view(np.uint8)
+            self.entries[key] = (offset, nbytes, value.shape, value.dtype.str)
+            self.end = max(self.end, offset + nbytes)
+
+    def _find_free(self, nbytes):
+        # Offset of the first free region of nbytes between the live entries (first fit), or None
+        start = 0
+        for offset, size, _, _ in sorted(self.entries.values(), key=lambda entry: entry[0]):
+            if offset - start >= nbytes:
+                return start
+            start = max(start, offset + size)
+        self.end = start
+        return start if self.max_bytes - start >= nbytes else None
+
+    def flush(self):
+        # Data first, then the index through a temporary file, so the index on disk only lists data that is written
+        with self.lock:
+            self.data.flush()
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(dict(entries=self.entries, file_hashes=self.file_hashes), f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.index_path)
+
+    close = flush
+
+
+def cached_rows(cache, images_list, kind, params, compute):
+    """Per-image rows for images_list, taken from cache where possible.
+
+    Missing rows are computed in a single compute(missing_indices) call and stored; cache may be None.
+    """
+    if cache is None:
+        return np.asarray(compute(list(range(len(images_list)))))
+    keys = [cache.key(path, kind, *params) for path in images_list]
+    rows = [cache.get(key) for key in keys]
+    missing = [i for i, row in enumerate(rows) if row is None]
+    if missing:
+        for i, row in zip(missing, compute(missing)):
+            rows[i] = np.asarray(row)
+            cache.put(keys[i], rows[i])
+    return np.stack(rows)
@@ -0,0 +1,46 @@
+import numpy as np
+
+
+class ConvergenceMonitor:
+    """Per-image convergence check for the encoder, evaluated on the host from the per-image loss of each step.
+
+    An image has converged when its best loss reaches target_loss, or when its best loss improved by less than
+    rel_tol (relative) over the last window steps.
+    """
+    def __init__(self, batch_size, window=50, rel_tol=1e-3, target_loss=None):
+        self.batch_size = batch_size
+        self.window = window
+        self.rel_tol = rel_tol
+        self.target_loss = target_loss
+        self.history = np.full((window + 1, batch_size), np.inf, dtype=np.float32)
+        self.steps = np.zeros(batch_size, dtype=np.int64)
+        self.converged = np.zeros(batch_size, dtype=bool)
+
+    def reset(self, rows=None):
+        rows = slice(None) if rows is None else rows
+        self.history[:, rows] = np.inf
+        self.steps[rows] = 0
+        self.converged[rows] = False
+
+    def update(self, loss_per_image):
+        # Accepts one (batch,) step or a (steps, batch) trace; returns the mask of images that converged just now
+        loss_per_image = np.asarray(loss_per_image, dtype=np.float32).reshape(-1, self.batch_size)
+        for loss in loss_per_image:
+            best = np.minimum(self.history[-1], loss)
+            self.history = np.roll(self.history, -1, axis=0)
+            self.history[-1] = best
+            self.steps += 1
+        newly_converged = np.zeros(self.batch_size, dtype=bool)
+        if self.target_loss is not None:
+            newly_converged |= self.history[-1] <= self.target_loss
+        if self.window > 0:
+            previous = self.history[0]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                improvement = (previous - self.history[-1]) / np.abs(previous)
+            newly_converged |= (self.steps > self.window) & (improvement < self.rel_tol)
+        newly_converged &= ~self.converged
+        self.converged |= newly_converged
+        return newly_converged
+
+    def all_converged(self, count=None):
+        return bool(np.all(self.converged[:count]))
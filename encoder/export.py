@@ -0,0 +1,87 @@
+import time
+import numpy as np
+import tensorflow as tf
+
+SIGNATURES = ('set_refs', 'step', 'get_results')
+
+
+def export_encoder(export_dir, perceptual_model):
+    """Save the fully built encoder graph and its variables (Gs weights included) as a SavedModel.
+
+    The graph is exported as it is: the loss weights, image size, batch size, steps_per_call and schedules it was
+    built with are part of it.
+    """
+    signatures = perceptual_model.build_signatures()
+    info = tf.saved_model.utils.build_tensor_info
+    signature_def_map = {
+        name: tf.saved_model.signature_def_utils.build_signature_def(
+            inputs={key: info(tensor) for key, tensor in inputs.items()},
+            outputs={key: info(tensor) for key, tensor in outputs.items()},
+            method_name=tf.saved_model.signature_constants.PREDICT_METHOD_NAME)
+        for name, (inputs, outputs) in signatures.items()}
+    builder = tf.saved_model.builder.SavedModelBuilder(export_dir)
+    builder.add_meta_graph_and_variables(perceptual_model.sess, [tf.saved_model.tag_constants.SERVING],
+                                         signature_def_map=signature_def_map, clear_devices=True)
+    builder.save()
+
+
+class ExportedEncoder:
+    """Encoder restored from export_encoder(): no pickle loading or graph construction, only the graph import and
+    a variable restore.
+
+    Images are uint8 (batch, image_size, image_size, 3), as returned by encoder.image_loader.load_images (any array
+    in 0..255 works, they are fed as float32).
+    Partial batches are padded, and the padding slots are left inactive.
+    """
+    def __init__(self, export_dir, sess=None, config=None):
+        start = time.perf_counter()
+        self.graph = tf.Graph() if sess is None else sess.graph
+        self.sess = tf.Session(graph=self.graph, config=config) if sess is None else sess
+        with self.graph.as_default():
+            meta_graph = tf.saved_model.loader.load(self.sess, [tf.saved_model.tag_constants.SERVING], export_dir)
+        self.signatures = {}
+        for name in SIGNATURES:
+            signature = meta_graph.signature_def[name]
+            self.signatures[name] = ({key: self.graph.get_tensor_by_name(value.name) for key, value in signature.inputs.items()},
+                                     {key: self.graph.get_tensor_by_name(value.name) for key, value in signature.outputs.items()})
+        self.load_time = time.perf_counter() - start
+        inputs = self.signatures['set_refs'][0]
+        self.batch_size = inputs['active'].shape.as_list()[0]
+        self.image_size = inputs['ref_weight'].shape.as_list()[1]
+        self.dlatent_shape = inputs['dlatents'].shape.as_list()[1:]
+
+    def _run(self, name, feeds=None):
+        inputs, outputs = self.signatures[name]
+        feed_dict = {inputs[key]: value for key, value in (feeds or {}).items()}
+        return self.sess.run(outputs, feed_dict)
+
+    def _pad(self, rows, shape, fill=0):
+        padded = np.full([self.batch_size] + shape, fill, dtype=np.float32)
+        if rows is not None:
+            padded[:len(rows)] = rows
+        return padded
+
+    def set_refs(self, ref_img, ref_weight=None, dlatents=None):
+        count = len(ref_img)
+        image_shape = [self.image_size, self.image_size, 3]
+        if ref_weight is None:
+            ref_weight = np.ones([count] + image_shape, dtype=np.float32)
+        return self._run('set_refs', dict(ref_img=self._pad(ref_img, image_shape), ref_weight=self._pad(ref_weight, image_shape),
+                                          dlatents=self._pad(dlatents, self.dlatent_shape),
+                                          active=(np.arange(self.batch_size) < count).astype(np.float32)))
+
+    def step(self):
+        return self._run('step')
+
+    def get_results(self):
+        return self._run('get_results')
+
+    def encode(self, ref_img, ref_weight=None, dlatents=None, iterations=100):
+        # Encode one batch with iterations step() calls (each runs the exported steps_per_call steps); returns the
+        # best dlatents, losses and images of the given rows
+        count = len(ref_img)
+        self.set_refs(ref_img, ref_weight, dlatents)
+        for _ in range(iterations):
+            self.step()
+        results = self.get_results()
+        return {key: value[:count] for key, value in results.items()}
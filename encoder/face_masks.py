@@ -0,0 +1,112 @@
+import os
+import bz2
+import threading
+import traceback
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import PIL.Image
+import numpy as np
+from encoder import image_loader
+
+LANDMARKS_MODEL_URL = 'http://dlib.net/files/shape_predictor_68_face_landmarks.dat.bz2'
+
+
+def unpack_bz2(src_path):
+    dst_path = src_path[:-4]
+    if not os.path.isfile(dst_path):
+        data = bz2.BZ2File(src_path).read()
+        with open(dst_path, 'wb') as fp:
+            fp.write(data)
+    return dst_path
+
+def landmarks_model_path():
+    from keras.utils import get_file
+    return unpack_bz2(get_file('shape_predictor_68_face_landmarks.dat.bz2', LANDMARKS_MODEL_URL, cache_subdir='temp'))
+
+def mask_path(mask_dir, img_path):
+    # Masks are saved as PNG under the reference image's file name
+    return os.path.join(mask_dir, os.path.basename(img_path))
+
+def generate_face_mask(im, detector, predictor, use_grabcut=True, scale_mask=1.5):
+    from imutils import face_utils
+    import cv2
+    rects = detector(im, 1)
+    # loop over the face detections
+    for (j, rect) in enumerate(rects):
+        """
+        Determine the facial landmarks for the face region, then convert the facial landmark (x, y)-coordinates to a NumPy array
+        """
+        shape = predictor(im, rect)
+        shape = face_utils.shape_to_np(shape)
+
+        # we extract the face
+        vertices = cv2.convexHull(shape)
+        mask = np.zeros(im.shape[:2],np.uint8)
+        cv2.fillConvexPoly(mask, vertices, 1)
+        if use_grabcut:
+            bgdModel = np.zeros((1,65),np.float64)
+            fgdModel = np.zeros((1,65),np.float64)
+            rect = (0,0,im.shape[1],im.shape[2])
+            (x,y),radius = cv2.minEnclosingCircle(vertices)
+            center = (int(x),int(y))
+            radius = int(radius*scale_mask)
+            mask = cv2.circle(mask,center,radius,cv2.GC_PR_FGD,-1)
+            cv2.fillConvexPoly(mask, vertices, cv2.GC_FGD)
+            cv2.grabCut(im,mask,rect,bgdModel,fgdModel,5,cv2.GC_INIT_WITH_MASK)
+            mask = np.where((mask==2)|(mask==0),0,1)
+        return mask
+
+# Per worker process: dlib models are loaded once by the pool initializer
+_detector = None
+_predictor = None
+
+def _init_worker(predictor_path):
+    global _detector, _predictor
+    import dlib
+    _detector = dlib.get_frontal_face_detector()
+    _predictor = dlib.shape_predictor(predictor_path)
+
+def _mask_job(img_path, dst_path, image_size, use_grabcut, scale_mask):
+    # Returns None on success or the error message; the image is loaded exactly as for the encoder's references
+    try:
+        im = image_loader.load_images([img_path], image_size)[0]
+        mask = generate_face_mask(im, _detector, _predictor, use_grabcut, scale_mask)
+        PIL.Image.fromarray((255*mask).astype('uint8'), 'L').save(dst_path, 'PNG')
+        return None
+    except Exception:
+        return traceback.format_exc()
+
+class MaskPrecomputer:
+    """Generates face masks into mask_dir on a process pool, ahead of the images being encoded.
+
+    submit() queues every image whose mask is not in mask_dir yet; wait(img_path) blocks until that image's mask
+    is written (or failed). Masks already on disk are never recomputed.
+    """
+    def __init__(self, mask_dir, image_size, use_grabcut=True, scale_mask=1.5, workers=None, predictor_path=None):
+        self.mask_dir = mask_dir
+        self.image_size = image_size
+        self.use_grabcut = use_grabcut
+        self.scale_mask = scale_mask
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.pool = ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=mp.get_context('spawn'),
+                                        initializer=_init_worker, initargs=(predictor_path or landmarks_model_path(),))
+
+    def submit(self, images_list):
+        with self.lock:
+            for img_path in images_list:
+                dst_path = mask_path(self.mask_dir, img_path)
+                if img_path in self.futures or os.path.isfile(dst_path):
+                    continue
+                self.futures[img_path] = self.pool.submit(_mask_job, img_path, dst_path, self.image_size,
+                                                          self.use_grabcut, self.scale_mask)
+        return [self.futures[img_path] for img_path in images_list if img_path in self.futures]
+
+    def wait(self, img_path):
+        # Returns the worker's error (traceback) if the mask could not be generated, otherwise None
+        with self.lock:
+            future = self.futures.pop(img_path, None)
+        return None if future is None else future.result()
+
+    def close(self):
+        self.pool.shutdown()
@@ -1,4 +1,5 @@
 import math
+import inspect
 import tensorflow as tf
 import numpy as np
 import dnnlib.tflib as tflib
@@ -23,10 +24,32 @@ def create_variable_for_generator(name, batch_size, tiled_dlatent, model_scale=1
             initializer=tf.initializers.random_normal())
 
 
+_local_synthesis_source = False
+
+def use_local_synthesis_source():
+    # Truncated synthesis needs the output_lod argument of training/networks_stylegan.G_synthesis, but an unpickled
+    # network is rebuilt from the source stored in its pickle (the FFHQ one silently ignores output_lod).
+    # Call before unpickling to rebuild G_synthesis from the local source instead; its variables are the same.
+    global _local_synthesis_source
+    if not _local_synthesis_source:
+        tflib.network.import_handler(_synthesis_source_handler)
+        _local_synthesis_source = True
+
+def _synthesis_source_handler(state):
+    if state['build_func_name'] == 'G_synthesis' and 'output_lod' not in state['build_module_src']:
+        import training.networks_stylegan
+        state = dict(state, build_module_src=inspect.getsource(training.networks_stylegan))
+    return state
+
+
 class Generator:
-    def __init__(self, model, batch_size, clip_range=[-0.5, 1.5], tiled_dlatent=False, model_res=1024, randomize_noise=False):
+    def __init__(self, model, batch_size, clip_range=[-0.5, 1.5], tiled_dlatent=False, model_res=1024, randomize_noise=False, dtype='float32'):
         self.batch_size = batch_size
+        self.dtype = dtype # synthesis activations; dlatents and outputs stay float32
         self.tiled_dlatent=tiled_dlatent
+        self.randomize_noise = randomize_noise
+        self.synthesis = model.components.synthesis
+        self.model_res = model_res
         self.model_scale = int(2*(math.log(model_res,2)-1)) # For example, 1024 -> 18
 
         if tiled_dlatent:
@@ -35,14 +58,14 @@ class Generator:
                 randomize_noise=randomize_noise, minibatch_size=self.batch_size,
                 custom_inputs=[partial(create_variable_for_generator, batch_size=batch_size, tiled_dlatent=True),
                                                 partial(create_stub, batch_size=batch_size)],
-                structure='fixed')
+                structure='fixed', dtype=dtype)
         else:
             self.initial_dlatents = np.zeros((self.batch_size, self.model_scale, 512))
             model.components.synthesis.run(self.initial_dlatents,
                 randomize_noise=randomize_noise, minibatch_size=self.batch_size,
                 custom_inputs=[partial(create_variable_for_generator, batch_size=batch_size, tiled_dlatent=False, model_scale=self.model_scale),
                                                 partial(create_stub, batch_size=batch_size)],
-                structure='fixed')
+                structure='fixed', dtype=dtype)
 
         self.dlatent_avg_def = model.get_var('dlatent_avg')
         self.reset_dlatent_avg()
@@ -50,6 +73,12 @@ class Generator:
         self.graph = tf.get_default_graph()
 
         self.dlatent_variable = next(v for v in tf.global_variables() if 'learnable_dlatents' in v.name)
+        # Placeholder-fed setter, so setting dlatents doesn't add a new assign op and constant to the graph on every call
+        self.dlatent_placeholder = tf.placeholder(self.dlatent_variable.dtype, shape=self.dlatent_variable.shape)
+        self.set_dlatents_op = tf.assign(self.dlatent_variable, self.dlatent_placeholder)
+        self.dlatent_rows_placeholder = tf.placeholder(tf.int32, shape=[None])
+        self.dlatent_rows_values_placeholder = tf.placeholder(self.dlatent_variable.dtype, shape=[None] + self.dlatent_variable.shape.as_list()[1:])
+        self.set_dlatent_rows_op = tf.scatter_update(self.dlatent_variable, self.dlatent_rows_placeholder, self.dlatent_rows_values_placeholder)
         self.set_dlatents(self.initial_dlatents)
 
         def get_tensor(name):
@@ -77,18 +106,43 @@ class Generator:
 
         self.generated_image = tflib.convert_images_to_uint8(self.generator_output, nchw_to_nhwc=True, uint8_cast=False)
         self.generated_image_uint8 = tf.saturate_cast(self.generated_image, tf.uint8)
+        self._resized_images = {}
 
         # Implement stochastic clipping similar to what is described in https://arxiv.org/abs/1702.04782
         # (Slightly different in that the latent space is normal gaussian here and was uniform in [-1, 1] in that paper,
         # so we clip any vector components outside of [-2, 2]. It seems fine, but I haven't done an ablation check.)
-        ct_min = clip_range[0]
-        ct_max = clip_range[1]
-        clipping_mask = tf.math.logical_or(self.dlatent_variable > ct_max, self.dlatent_variable < ct_min)
-        clip_val_distr = tf.random_uniform(shape=self.dlatent_variable.shape, minval=ct_min, maxval=ct_max)
+        self.clip_range = clip_range
+        self.stochastic_clip_op = tf.assign(self.dlatent_variable, self.stochastic_clip(self.dlatent_variable))
+
+    def stochastic_clip(self, dlatents):
+        ct_min = self.clip_range[0]
+        ct_max = self.clip_range[1]
+        clipping_mask = tf.math.logical_or(dlatents > ct_max, dlatents < ct_min)
+        clip_val_distr = tf.random_uniform(shape=dlatents.shape, minval=ct_min, maxval=ct_max)
         # tf.random_normal(shape=self.dlatent_variable.shape, stddev=0.1, mean=0.)
         # clip_val_distr = tf.random_gamma(shape=self.dlatent_variable.shape, alpha=2, beta=3) * 1.2 / 2.5 - 0.3
-        clipped_values = tf.where(clipping_mask, clip_val_distr, self.dlatent_variable)
-        self.stochastic_clip_op = tf.assign(self.dlatent_variable, clipped_values)
+        return tf.where(clipping_mask, clip_val_distr, dlatents)
+
+    def synthesize(self, dlatents, resolution=None):
+        # Build another synthesis graph for a dlatents expression (e.g. inside a tf.while_loop), sharing the model weights.
+        # With a resolution below model_res the synthesis network stops early at that resolution (the upper layers'
+        # dlatents then get no image gradient); that needs use_local_synthesis_source() before loading the pickle.
+        if self.tiled_dlatent:
+            dlatents = tf.tile(tf.expand_dims(dlatents, axis=1), [1, self.model_scale, 1])
+        output_lod = 0 if resolution is None else int(math.log(self.model_res / resolution, 2))
+        images = self.synthesis.get_output_for(dlatents, randomize_noise=self.randomize_noise, structure='fixed', output_lod=output_lod,
+                                               dtype=self.dtype)
+        expected = self.model_res if resolution is None else resolution
+        assert images.shape.as_list()[2:] == [expected, expected], \
+            'synthesis output is %s, expected %dx%d: was the network unpickled after use_local_synthesis_source()?' % (images.shape, expected, expected)
+        return tflib.convert_images_to_uint8(images, nchw_to_nhwc=True, uint8_cast=False)
+
+    def get_resized_images_tensor(self, size):
+        # uint8 generated images downsampled on the device (area filter), built once per size
+        if size not in self._resized_images:
+            resized = tf.image.resize_area(self.generated_image, (size, size))
+            self._resized_images[size] = tf.saturate_cast(resized, tf.uint8)
+        return self._resized_images[size]
 
     def reset_dlatents(self):
         self.set_dlatents(self.initial_dlatents)
@@ -106,7 +160,36 @@ class Generator:
             if (dlatents.shape != (self.batch_size, self.model_scale, 512)):
                 dlatents = np.vstack([dlatents, np.zeros((self.batch_size-dlatents.shape[0], self.model_scale, 512))])
             assert (dlatents.shape == (self.batch_size, self.model_scale, 512))
-        self.sess.run(tf.assign(self.dlatent_variable, dlatents))
+        self.sess.run(self.set_dlatents_op, {self.dlatent_placeholder: dlatents})
+
+    def _prepare_dlatent(self, dlatent):
+        # Bring a single image's dlatent to the per-row shape of dlatent_variable
+        dlatent = np.asarray(dlatent)
+        if (dlatent.ndim == len(self.initial_dlatents.shape)):
+            dlatent = dlatent[0]
+        if self.tiled_dlatent:
+            if (dlatent.ndim == 2):
+                dlatent = np.mean(dlatent, axis=0)
+        else:
+            dlatent = dlatent[:self.model_scale]
+        return dlatent
+
+    def set_dlatents_many(self, dlatents_list):
+        # Set up to batch_size per-image dlatents in a single run; missing (or None) entries keep the initial dlatents
+        assert (len(dlatents_list) <= self.batch_size)
+        dlatents = np.array(self.initial_dlatents, dtype=np.float32)
+        for i, dlatent in enumerate(dlatents_list):
+            if dlatent is not None:
+                dlatents[i] = self._prepare_dlatent(dlatent)
+        self.sess.run(self.set_dlatents_op, {self.dlatent_placeholder: dlatents})
+
+    def set_dlatent_rows(self, rows, dlatents_list):
+        # Set the dlatents of some batch slots only; None entries get the initial dlatents
+        dlatents = np.array(self.initial_dlatents[:len(rows)], dtype=np.float32)
+        for i, dlatent in enumerate(dlatents_list):
+            if dlatent is not None:
+                dlatents[i] = self._prepare_dlatent(dlatent)
+        self.sess.run(self.set_dlatent_rows_op, {self.dlatent_rows_placeholder: rows, self.dlatent_rows_values_placeholder: dlatents})
 
     def stochastic_clip_dlatents(self):
         self.sess.run(self.stochastic_clip_op)
@@ -124,6 +207,6 @@ class Generator:
         self.dlatent_avg = self.dlatent_avg_def
 
     def generate_images(self, dlatents=None):
-        if dlatents:
+        if dlatents is not None:
             self.set_dlatents(dlatents)
         return self.sess.run(self.generated_image_uint8)
@@ -0,0 +1,32 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import PIL.Image
+import numpy as np
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool():
+    # One bounded decode pool per process; PIL releases the GIL while decoding and resizing
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+    return _pool
+
+def _load_image_into(loaded_images, i, img_path, image_size):
+    img = PIL.Image.open(img_path)
+    img = img.convert('RGB').resize((image_size,image_size),PIL.Image.LANCZOS)
+    loaded_images[i] = np.asarray(img)
+
+def load_images(images_list, image_size=256):
+    """Decode and resize images in parallel straight into one preallocated uint8 array of shape (n, size, size, 3)."""
+    loaded_images = np.empty((len(images_list), image_size, image_size, 3), dtype=np.uint8)
+    if len(images_list) == 1:
+        _load_image_into(loaded_images, 0, images_list[0], image_size)
+    else:
+        futures = [_get_pool().submit(_load_image_into, loaded_images, i, img_path, image_size) for i, img_path in enumerate(images_list)]
+        for future in futures:
+            future.result()
+    return loaded_images
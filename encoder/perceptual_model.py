@@ -8,16 +8,10 @@ from keras.utils import get_file
 from keras.applications.vgg16 import VGG16, preprocess_input
 import keras.backend as K
 import traceback
+from encoder import image_loader
 
 def load_images(images_list, image_size=256):
-    loaded_images = list()
-    for img_path in images_list:
-      img = PIL.Image.open(img_path).convert('RGB').resize((image_size,image_size),PIL.Image.LANCZOS)
-      img = np.array(img)
-      img = np.expand_dims(img, 0)
-      loaded_images.append(img)
-    loaded_images = np.vstack(loaded_images)
-    return loaded_images
+    return image_loader.load_images(images_list, image_size)
 
 def tf_custom_l1_loss(img1,img2):
   return tf.math.reduce_mean(tf.math.abs(img2-img1), axis=None)
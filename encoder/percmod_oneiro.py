@@ -8,26 +8,57 @@ from keras.utils import get_file
 from keras.applications.vgg16 import VGG16, preprocess_input
 import keras.backend as K
 import traceback
+from functools import partial
+import dnnlib.tflib as tflib
+from encoder import image_loader
+from encoder.cache import cached_rows
+from encoder.profiler import Profiler
+from encoder import face_masks
 
 def load_images(images_list, image_size=160):
-    loaded_images = list()
-    for img_path in images_list:
-      img = PIL.Image.open(img_path).convert('RGB').resize((image_size,image_size),PIL.Image.LANCZOS)
-      img = np.array(img)
-      img = np.expand_dims(img, 0)
-      loaded_images.append(img)
-    loaded_images = np.vstack(loaded_images)
-    return loaded_images
+    return image_loader.load_images(images_list, image_size)
 
 def tf_custom_l1_loss(img1,img2):
   return tf.math.reduce_mean(tf.math.abs(img2-img1), axis=None)
 
-def tf_euclidian_dist(emb1, emb2):
-    return tf.reduce_sum(tf.square(tf.subtract(emb1, emb2)), axis=None)
+def tf_euclidian_dist(emb1, emb2, axis=None):
+    return tf.reduce_sum(tf.square(tf.subtract(emb1, emb2)), axis=axis)
+
+def tf_per_image_mean(x):
+    # Mean over everything but the batch axis
+    if x.shape.ndims <= 1:
+        return x
+    return tf.math.reduce_mean(x, axis=list(range(1, x.shape.ndims)))
+
+def tf_ssim_multiscale(img1, img2, size):
+    # MS-SIM with as many scales as fit in size x size images (5 at 176px and up)
+    power_factors = (0.0448, 0.2856, 0.3001, 0.2363, 0.1333)
+    scales = int(np.clip(np.floor(np.log2(size / 11.0)) + 1, 1, len(power_factors)))
+    return tf.image.ssim_multiscale(img1, img2, 1, power_factors=power_factors[:scales])
 
 def tf_custom_logcosh_loss(img1,img2):
   return tf.math.reduce_mean(tf.keras.losses.logcosh(img1,img2))
 
+def adam_update(var, grad, m, v, step, lr, mask=None, beta1=0.9, beta2=0.999, epsilon=1e-8):
+    # Adam on explicit slot variables (same math as tf.train.AdamOptimizer), so the update can also be built inside a tf.while_loop.
+    # mask (per row of var) freezes rows: their gradient and update are zeroed.
+    # step and lr may be scalars or per row of var.
+    def per_row(x):
+        x = tf.cast(x, tf.float32)
+        return tf.reshape(x, [-1] + [1] * (var.shape.ndims - 1)) if x.shape.ndims == 1 else x
+    step = per_row(step)
+    lr = per_row(lr)
+    if mask is not None:
+        mask = per_row(mask)
+        grad = grad * mask
+    m_t = tf.assign(m, beta1 * m.read_value() + (1 - beta1) * grad)
+    v_t = tf.assign(v, beta2 * v.read_value() + (1 - beta2) * tf.square(grad))
+    lr_t = lr * tf.sqrt(1 - tf.pow(beta2, step)) / (1 - tf.pow(beta1, step))
+    update = lr_t * m_t / (tf.sqrt(v_t) + epsilon)
+    if mask is not None:
+        update = update * mask
+    return tf.assign_sub(var, update)
+
 def unpack_bz2(src_path):
     data = bz2.BZ2File(src_path).read()
     dst_path = src_path[:-4]
@@ -36,8 +67,10 @@ def unpack_bz2(src_path):
     return dst_path
 
 class PerceptualModel:
-    def __init__(self, args, batch_size=1, perc_model=None, sess=None):
+    def __init__(self, args, batch_size=1, perc_model=None, sess=None, cache=None, profiler=None):
         self.sess = tf.get_default_session() if sess is None else sess
+        self.cache = cache
+        self.profiler = Profiler(enabled=False) if profiler is None else profiler
         K.set_session(self.sess)
         self.epsilon = 0.00000001
         self.lr = args.lr
@@ -45,7 +78,17 @@ class PerceptualModel:
         self.decay_steps = args.decay_steps
         self.img_size = args.image_size
         self.fn_loss = args.use_fn_loss
+        if (self.fn_loss <= self.epsilon):
+            self.fn_loss = None
         self.fn_model_path = args.fn_model_path
+        self.steps_per_call = args.steps_per_call
+        self.stochastic_clip = args.stochastic_clip
+        self.loss_pyramid = args.loss_pyramid # [(size, until_step), ...], coarsest first
+        self.truncated_synthesis = args.truncated_synthesis # [(resolution, until_step), ...], lowest first
+        self.use_fp16 = args.use_fp16
+        self.loss_scaling = None
+        self.video_size = args.video_size if args.output_video else 0
+        self.video_frames = None # uint8 frames at video_size of the images the last step's loss was computed on
 
         self.face_mask = args.face_mask
         self.use_grabcut = args.use_grabcut
@@ -73,14 +116,17 @@ class PerceptualModel:
         self.perceptual_model = None
         self.ref_img_features = None
         self.loss = None
+        self.generator = None
+        self._fn_graph_def = None
+        self._min_op = None
+        self._best_images = None
+        self.mask_precomputer = None # optional face_masks.MaskPrecomputer writing masks into mask_dir ahead of time
 
         if self.face_mask:
             import dlib
             self.detector = dlib.get_frontal_face_detector()
-            LANDMARKS_MODEL_URL = 'http://dlib.net/files/shape_predictor_68_face_landmarks.dat.bz2'
-            landmarks_model_path = unpack_bz2(get_file('shape_predictor_68_face_landmarks.dat.bz2',
-                                                    LANDMARKS_MODEL_URL, cache_subdir='temp'))
-            self.predictor = dlib.shape_predictor(landmarks_model_path)
+            self.landmarks_model_path = face_masks.landmarks_model_path()
+            self.predictor = dlib.shape_predictor(self.landmarks_model_path)
 
     def compare_images(self,img1,img2):
         if self.perc_model is not None:
@@ -95,14 +141,25 @@ class PerceptualModel:
     def assign_placeholder(self, var_name, var_val):
         self.sess.run(getattr(self, var_name + "_op"), {getattr(self, var_name + "_placeholder"): var_val})
 
+    def add_row_placeholder(self, var_name):
+        var_val = getattr(self, var_name)
+        setattr(self, var_name + "_rows_placeholder", tf.placeholder(tf.int32, shape=[None]))
+        setattr(self, var_name + "_rows_values_placeholder", tf.placeholder(var_val.dtype, shape=[None] + var_val.get_shape().as_list()[1:]))
+        setattr(self, var_name + "_rows_op", tf.scatter_update(var_val, getattr(self, var_name + "_rows_placeholder"),
+                                                               getattr(self, var_name + "_rows_values_placeholder")))
+
+    def assign_rows(self, var_name, rows, var_val):
+        self.sess.run(getattr(self, var_name + "_rows_op"), {getattr(self, var_name + "_rows_placeholder"): rows,
+                                                              getattr(self, var_name + "_rows_values_placeholder"): var_val})
+
     def build_perceptual_model(self, generator):
-        # Learning rate
-        global_step = tf.Variable(0, dtype=tf.int32, trainable=False, name="global_step")
-        incremented_global_step = tf.assign_add(global_step, 1)
-        self._reset_global_step = tf.assign(global_step, 0)
-        self.learning_rate = tf.train.exponential_decay(self.lr, incremented_global_step,
-                self.decay_steps, self.decay_rate, staircase=True)
+        self.generator = generator
+        # Step counter of the loss schedules. A resource variable, so step_value (read once per step and passed to
+        # everything that follows the schedule) is a snapshot that the step's own increment can't change.
+        self.global_step = tf.Variable(0, dtype=tf.int32, trainable=False, name="global_step", use_resource=True)
+        self._reset_global_step = tf.assign(self.global_step, 0)
         self.sess.run([self._reset_global_step])
+        self.step_value = self.global_step.read_value()
 
         generated_image_tensor = generator.generated_image
         generated_image = tf.image.resize_bilinear(generated_image_tensor,
@@ -114,131 +171,390 @@ class PerceptualModel:
                                                dtype='float32', initializer=tf.initializers.zeros())
         self.add_placeholder("ref_img")
         self.add_placeholder("ref_weight")
+        self.add_row_placeholder("ref_img")
+        self.add_row_placeholder("ref_weight")
 
         if (self.fn_loss is not None):
             with tf.gfile.FastGFile(self.fn_model_path, 'rb') as f:
-                graph_def = tf.GraphDef()
-                graph_def.ParseFromString(f.read())
-                gen_img_fn = tf.image.resize_bilinear(generated_image_tensor, (160, 160), align_corners=True)
-                gen_img_fn_w = tf.image.per_image_standardization(gen_img_fn)
-                tf.import_graph_def(graph_def, input_map={'input': gen_img_fn_w, 'phase_train': tf.constant(False)}, name='')
+                self._fn_graph_def = tf.GraphDef()
+                self._fn_graph_def.ParseFromString(f.read())
             # self.perceptual_model = facenet.load_model(self.fn_model_path, input_map={'input': generated_image_w, 'phase_train': tf.constant(False)})
-
-            self.images_placeholder = self.sess.graph.get_tensor_by_name("input:0")
-            self.embeddings = self.sess.graph.get_tensor_by_name("embeddings:0")
-            #self.embeddings.set_shape((1, 512))
-            self.phase_train_placeholder = self.sess.graph.get_tensor_by_name("phase_train:0")
-            self.ref_img_features = tf.get_variable('ref_img_features', shape=(1, 512),
+            # One reference embedding per batch slot, compared image by image in _build_loss
+            self.ref_img_features = tf.get_variable('ref_img_features', shape=(self.batch_size, 512),
                                                 dtype='float32', initializer=tf.initializers.random_uniform())
             self.sess.run([self.ref_img_features.initializer])
             self.add_placeholder("ref_img_features")
+            self.add_row_placeholder("ref_img_features")
+
+        self.loss_image = self._scheduled_image(generator.dlatent_variable, self.step_value, generated_image_tensor)
+        self.loss_per_image = self._build_loss(self.loss_image, generator.dlatent_variable, self.step_value)
+        self.loss = tf.math.reduce_mean(self.loss_per_image)
 
-        self.loss = 0
-        # L1 loss on VGG16 features
         if (self.fn_loss is not None):
-            self.loss += self.fn_loss * tf_euclidian_dist(self.ref_img_features, self.embeddings)
+            # Reference embeddings get their own FaceNet input, built once and fed with any number of images
+            self.fn_ref_placeholder = tf.placeholder(tf.float32, shape=[None, self.img_size, self.img_size, 3])
+            self.fn_ref_embeddings = self._fn_embeddings(self.fn_ref_placeholder, name='fn_ref')
+
+    def _scheduled_image(self, dlatents, step, generated_image_tensor=None):
+        # Generated images for the loss. With truncated synthesis, the synthesis network stops at a lower resolution
+        # for the first iterations (tf.case on step, so only one synthesis graph runs per step) and only the
+        # final phase runs it to full resolution, which is also when the upper dlatent layers start to get gradients.
+        # Every branch builds its own synthesis: a tensor from outside the case would be computed on every step.
+        if not self.truncated_synthesis:
+            return self.generator.synthesize(dlatents) if generated_image_tensor is None else generated_image_tensor
+        levels = [(step < until, partial(self.generator.synthesize, dlatents, size)) for size, until in self.truncated_synthesis]
+        return tf.case(levels, default=partial(self.generator.synthesize, dlatents), exclusive=False)
+
+    def _synthesis_layers(self, step):
+        # Number of dlatent layers the (possibly truncated) synthesis uses at this step
+        layers = tf.constant(self.generator.model_scale)
+        for size, until in reversed(self.truncated_synthesis):
+            layers = tf.where(step < until, tf.constant(int(2 * np.log2(size) - 2)), layers)
+        return layers
+
+    def _fn_embeddings(self, generated_image_tensor, name=''):
+        gen_img_fn = tf.image.resize_bilinear(generated_image_tensor, (160, 160), align_corners=True)
+        gen_img_fn_w = tf.image.per_image_standardization(gen_img_fn)
+        return tf.import_graph_def(self._fn_graph_def, input_map={'input': gen_img_fn_w, 'phase_train': tf.constant(False)},
+                                   return_elements=['embeddings:0'], name=name)[0]
+
+    def _image_losses(self, generated_image_tensor, size):
+        # Pixel, MS-SIM and LPIPS losses per image, compared at size x size
+        ref_img = self.ref_img.read_value()
+        ref_weight = self.ref_weight.read_value()
+        if size == self.img_size:
+            generated_image = tf.image.resize_bilinear(generated_image_tensor,
+                                                                      (self.img_size, self.img_size), align_corners=True)
+        else:
+            generated_image = tf.image.resize_area(generated_image_tensor, (size, size))
+            ref_img = tf.image.resize_area(ref_img, (size, size))
+            ref_weight = tf.image.resize_area(ref_weight, (size, size))
+        loss_per_image = tf.zeros([self.batch_size])
         # + logcosh loss on image pixels
         if (self.pixel_loss is not None):
-            self.loss += self.pixel_loss * tf_custom_logcosh_loss(self.ref_weight * self.ref_img, self.ref_weight * generated_image)
+            loss_per_image += self.pixel_loss * tf_per_image_mean(tf.keras.losses.logcosh(ref_weight * ref_img, ref_weight * generated_image))
         # + MS-SIM loss on image pixels
         if (self.mssim_loss is not None):
-            self.loss += self.mssim_loss * tf.math.reduce_mean(1-tf.image.ssim_multiscale(self.ref_weight * self.ref_img, self.ref_weight * generated_image, 1))
+            loss_per_image += self.mssim_loss * (1-tf_ssim_multiscale(ref_weight * ref_img, ref_weight * generated_image, size))
         # + extra perceptual loss on image pixels
         if self.perc_model is not None and self.lpips_loss is not None:
-            self.loss += self.lpips_loss * tf.math.reduce_mean(self.compare_images(self.ref_weight * self.ref_img, self.ref_weight * generated_image))
+            loss_per_image += self.lpips_loss * tf_per_image_mean(self.compare_images(ref_weight * ref_img, ref_weight * generated_image))
+        return loss_per_image
+
+    def _build_loss(self, generated_image_tensor, dlatents, step, name=''):
+        # Losses are kept per image, so each slot in the batch can be tracked (and checkpointed) on its own.
+        # step is this step's global_step value, read once.
+        loss_per_image = 0
+        # L1 loss on VGG16 features
+        if (self.fn_loss is not None):
+            embeddings = self._fn_embeddings(generated_image_tensor, name=name)
+            loss_per_image += self.fn_loss * tf_euclidian_dist(self.ref_img_features.read_value(), embeddings, axis=1)
+        # + image losses, coarse-to-fine if a loss pyramid is set: every level is built once, and tf.case picks
+        # the level for the current step so only its resizes and losses run
+        if self.loss_pyramid:
+            levels = [(step < until, partial(self._image_losses, generated_image_tensor, size)) for size, until in self.loss_pyramid]
+            loss_per_image += tf.case(levels, default=partial(self._image_losses, generated_image_tensor, self.img_size), exclusive=False)
+        else:
+            loss_per_image += self._image_losses(generated_image_tensor, self.img_size)
         # + L1 penalty on dlatent weights
         if self.l1_penalty is not None:
-            self.loss += self.l1_penalty * 512 * tf.math.reduce_mean(tf.math.abs(generator.dlatent_variable-generator.get_dlatent_avg()))
+            penalty = tf.math.abs(dlatents-self.generator.get_dlatent_avg())
+            if self.truncated_synthesis and not self.generator.tiled_dlatent:
+                # Layers above the resolution the synthesis stops at are left out, so they aren't pulled towards
+                # dlatent_avg while they get no image gradient
+                layers = self._synthesis_layers(step)
+                mask = tf.cast(tf.range(self.generator.model_scale) < layers, tf.float32)[tf.newaxis, :, tf.newaxis]
+                loss_per_image += self.l1_penalty * 512 * tf.reduce_sum(penalty * mask, axis=[1, 2]) / (tf.cast(layers, tf.float32) * 512)
+            else:
+                loss_per_image += self.l1_penalty * 512 * tf_per_image_mean(penalty)
+        return loss_per_image
 
     def generate_face_mask(self, im):
-        from imutils import face_utils
-        import cv2
-        rects = self.detector(im, 1)
-        # loop over the face detections
-        for (j, rect) in enumerate(rects):
-            """
-            Determine the facial landmarks for the face region, then convert the facial landmark (x, y)-coordinates to a NumPy array
-            """
-            shape = self.predictor(im, rect)
-            shape = face_utils.shape_to_np(shape)
-
-            # we extract the face
-            vertices = cv2.convexHull(shape)
-            mask = np.zeros(im.shape[:2],np.uint8)
-            cv2.fillConvexPoly(mask, vertices, 1)
-            if self.use_grabcut:
-                bgdModel = np.zeros((1,65),np.float64)
-                fgdModel = np.zeros((1,65),np.float64)
-                rect = (0,0,im.shape[1],im.shape[2])
-                (x,y),radius = cv2.minEnclosingCircle(vertices)
-                center = (int(x),int(y))
-                radius = int(radius*self.scale_mask)
-                mask = cv2.circle(mask,center,radius,cv2.GC_PR_FGD,-1)
-                cv2.fillConvexPoly(mask, vertices, cv2.GC_FGD)
-                cv2.grabCut(im,mask,rect,bgdModel,fgdModel,5,cv2.GC_INIT_WITH_MASK)
-                mask = np.where((mask==2)|(mask==0),0,1)
-            return mask
-
-    def set_reference_images(self, images_list):
-        assert(len(images_list) != 0 and len(images_list) <= self.batch_size)
-        loaded_image = load_images(images_list, self.img_size)
+        return face_masks.generate_face_mask(im, self.detector, self.predictor, self.use_grabcut, self.scale_mask)
+
+    def embed_reference_images(self, images, chunk_size=64):
+        # FaceNet embeddings of reference images (uint8 or float, image_size x image_size), computed chunk_size at a time
+        embeddings = np.empty((len(images), 512), dtype=np.float32)
+        for start in range(0, len(images), chunk_size):
+            chunk = images[start:start + chunk_size]
+            embeddings[start:start + len(chunk)] = self.sess.run(self.fn_ref_embeddings, {self.fn_ref_placeholder: chunk})
+        return embeddings
+
+    def _face_mask(self, img_path, im):
+        # Weight mask (h, w, 1) for one reference image, loaded from mask_dir or generated and saved there
+        try:
+            mask_img = face_masks.mask_path(self.mask_dir, img_path)
+            if self.mask_precomputer is not None:
+                error = self.mask_precomputer.wait(img_path)
+                if error is not None:
+                    raise RuntimeError(error)
+            if (os.path.isfile(mask_img)):
+                print("Loading mask " + mask_img)
+                imask = PIL.Image.open(mask_img).convert('L')
+                mask = np.array(imask)/255
+                mask = np.expand_dims(mask,axis=-1)
+            else:
+                mask = self.generate_face_mask(im)
+                imask = (255*mask).astype('uint8')
+                imask = PIL.Image.fromarray(imask, 'L')
+                print("Saving mask " + mask_img)
+                imask.save(mask_img, 'PNG')
+                mask = np.expand_dims(mask,axis=-1)
+        except Exception as e:
+            print("Exception in mask handling for " + img_path)
+            traceback.print_exc()
+            mask = np.ones(im.shape[:2] + (1,),np.float32)
+        return mask.astype(np.float32)
+
+    def _load_references(self, images_list, loaded_image=None):
+        # Reference images, weight masks and features for the given images (one row per image, no batch padding).
+        # With a cache, each of them is looked up by image content and preprocessing parameters first.
+        if loaded_image is None:
+            with self.profiler.stage('image_load'):
+                loaded_image = cached_rows(self.cache, images_list, 'ref_img', (self.img_size,),
+                                           lambda idx: load_images([images_list[i] for i in idx], self.img_size))
         image_features = None
-        if self.perceptual_model is not None or True:
-            imgs_fn = tf.image.resize_bilinear(np.array(loaded_image), (160, 160), align_corners=True)
-            imgs = tf.image.per_image_standardization(imgs_fn).eval(session=self.sess)
-            feed_dict = { self.images_placeholder:  np.array(imgs), self.phase_train_placeholder:False}
-            image_features = self.sess.run(self.embeddings, feed_dict=feed_dict)
+        if self.fn_loss is not None:
+            with self.profiler.stage('reference_embedding'):
+                image_features = cached_rows(self.cache, images_list, 'fn_embedding', (self.img_size, self.fn_model_path),
+                                             lambda idx: self.embed_reference_images(loaded_image[idx]))
 
+        images_space = list(self.ref_weight.shape[1:])
         if self.face_mask:
-            image_mask = np.zeros(self.ref_weight.shape)
-            for (i, im) in enumerate(loaded_image):
-                try:
-                    _, img_name = os.path.split(images_list[i])
-                    mask_img = os.path.join(self.mask_dir, f'{img_name}')
-                    if (os.path.isfile(mask_img)):
-                        print("Loading mask " + mask_img)
-                        imask = PIL.Image.open(mask_img).convert('L')
-                        mask = np.array(imask)/255
-                        mask = np.expand_dims(mask,axis=-1)
-                    else:
-                        mask = self.generate_face_mask(im)
-                        imask = (255*mask).astype('uint8')
-                        imask = PIL.Image.fromarray(imask, 'L')
-                        print("Saving mask " + mask_img)
-                        imask.save(mask_img, 'PNG')
-                        mask = np.expand_dims(mask,axis=-1)
-                    mask = np.ones(im.shape,np.float32) * mask
-                except Exception as e:
-                    print("Exception in mask handling for " + mask_img)
-                    traceback.print_exc()
-                    mask = np.ones(im.shape[:2],np.uint8)
-                    mask = np.ones(im.shape,np.float32) * np.expand_dims(mask,axis=-1)
-                image_mask[i] = mask
-            img = None
+            with self.profiler.stage('mask_generation'):
+                masks = cached_rows(self.cache, images_list, 'face_mask', (self.img_size, self.use_grabcut, self.scale_mask),
+                                    lambda idx: [self._face_mask(images_list[i], loaded_image[i]) for i in idx])
+            image_mask = np.ones([len(images_list)] + images_space, np.float32) * masks
         else:
-            image_mask = np.ones(self.ref_weight.shape)
+            image_mask = np.ones([len(images_list)] + images_space)
+        return loaded_image, image_mask, image_features
+
+    def set_reference_images(self, images_list, loaded_image=None):
+        assert(len(images_list) != 0 and len(images_list) <= self.batch_size)
+        loaded_image, image_mask, image_features = self._load_references(images_list, loaded_image)
+
+        if len(images_list) != self.batch_size:
+            images_space = list(self.ref_weight.shape[1:])
+            existing_images_space = [len(images_list)] + images_space
+            empty_images_space = [self.batch_size - len(images_list)] + images_space
+            existing_images = np.ones(shape=existing_images_space)
+            empty_images = np.zeros(shape=empty_images_space)
+            image_mask = image_mask * np.vstack([existing_images, empty_images])
+            loaded_image = np.vstack([loaded_image, np.zeros(empty_images_space)])
+            if image_features is not None:
+                image_features = np.vstack([image_features, np.zeros((self.batch_size - len(images_list), 512))])
 
         if image_features is not None:
             self.assign_placeholder("ref_img_features", image_features)
         self.assign_placeholder("ref_weight", image_mask)
         self.assign_placeholder("ref_img", loaded_image)
 
-    def optimize(self, vars_to_optimize, iterations=200):
+    def set_reference_rows(self, rows, images_list, loaded_image=None):
+        # Replace the references of some batch slots only, leaving the other slots untouched
+        assert(len(rows) == len(images_list) and len(rows) != 0)
+        loaded_image, image_mask, image_features = self._load_references(images_list, loaded_image)
+        if image_features is not None:
+            self.assign_rows("ref_img_features", rows, image_features)
+        self.assign_rows("ref_weight", rows, image_mask)
+        self.assign_rows("ref_img", rows, loaded_image)
+
+    def _build_step(self, loss_per_image, dlatents, step):
+        # One optimization step of the dlatent variable: record the best per-image dlatents, then apply Adam and
+        # (optionally) stochastic clipping. dlatents is the value read for this step's forward pass, and step the
+        # global_step value its schedules used; global_step is only incremented after that read.
+        # Learning rate decay and Adam bias correction follow each slot's own step count (row_step), so a slot
+        # refilled with a new image starts over while the others keep going.
+        dlatent_variable = self.generator.dlatent_variable
+        active = self.active.read_value()
+        with tf.control_dependencies([step]):
+            increment = tf.assign_add(self.global_step, 1)
+        row_step = tf.assign_add(self.row_step, tf.cast(active > 0, tf.int32))
+        learning_rate = self.lr * tf.pow(self.decay_rate, tf.floor(tf.cast(row_step, tf.float32) / self.decay_steps))
+
+        # Best per-image loss and dlatents stay on the device, updated in the same run as the step
+        # (and before it, so the recorded dlatents are the ones the loss was computed from)
+        best_loss = self.best_loss.read_value()
+        improved = loss_per_image < best_loss
+        update_best = tf.group(tf.assign(self.best_loss, tf.where(improved, loss_per_image, best_loss)),
+                               tf.assign(self.best_dlatents, tf.where(improved, dlatents, self.best_dlatents.read_value())))
+
+        loss = tf.math.reduce_mean(loss_per_image)
+        if self.loss_scaling is None:
+            grad = tf.gradients(loss, dlatents)[0]
+            with tf.control_dependencies([update_best]):
+                update = adam_update(dlatent_variable, grad, self.adam_m, self.adam_v, tf.maximum(row_step, 1), learning_rate, mask=active)
+        else:
+            # fp16 synthesis: dynamic loss scaling as in tflib.Optimizer. The step is skipped (and the scale lowered)
+            # when the fp16 backward pass overflowed; otherwise the scale slowly grows again.
+            grad = self.loss_scaling.undo_loss_scaling(tf.gradients(self.loss_scaling.apply_loss_scaling(loss), dlatents)[0])
+            grad_ok = tf.reduce_all(tf.is_finite(grad))
+            ls_var = self.loss_scaling.get_loss_scaling_var(loss.device)
+            with tf.control_dependencies([update_best]):
+                update = tf.cond(grad_ok,
+                                 lambda: tf.group(tf.assign_add(ls_var, self.loss_scaling.loss_scaling_inc),
+                                                  adam_update(dlatent_variable, grad, self.adam_m, self.adam_v, tf.maximum(row_step, 1), learning_rate, mask=active)),
+                                 lambda: tf.group(tf.assign_sub(ls_var, self.loss_scaling.loss_scaling_dec)))
+        if self.stochastic_clip:
+            with tf.control_dependencies([update]):
+                dlatents = dlatent_variable.read_value()
+                clipped = self.generator.stochastic_clip(dlatents)
+                update = tf.assign(dlatent_variable, tf.where(active > 0, clipped, dlatents))
+        return tf.group(update, increment), learning_rate
+
+    def build_optimizer(self, vars_to_optimize):
+        # The step ops and Adam slots are built once per process; later batches only run self._reset_op
+        if self._min_op is not None:
+            return
         vars_to_optimize = vars_to_optimize if isinstance(vars_to_optimize, list) else [vars_to_optimize]
-        optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate)
-        writer = tf.summary.FileWriter('./graphs', self.sess.graph)
-        min_op = optimizer.minimize(self.loss, var_list=[vars_to_optimize])
-        self.sess.run(tf.variables_initializer(optimizer.variables()))
-        self.sess.run(self._reset_global_step)
-        fetch_ops = [min_op, self.loss, self.learning_rate]
-        for _ in range(iterations):
-            _, loss, lr = self.sess.run(fetch_ops)
-            yield {"loss":loss, "lr": lr}
+        dlatent_variable = vars_to_optimize[0]
+        assert dlatent_variable is self.generator.dlatent_variable
+
+        self.best_loss = tf.get_variable('best_loss', shape=(self.batch_size,),
+                                         dtype='float32', initializer=tf.initializers.constant(np.inf), trainable=False)
+        self.best_dlatents = tf.get_variable('best_dlatents', shape=dlatent_variable.shape,
+                                             dtype='float32', initializer=tf.initializers.zeros(), trainable=False)
+        self.adam_m = tf.get_variable('adam_m', shape=dlatent_variable.shape,
+                                      dtype='float32', initializer=tf.initializers.zeros(), trainable=False)
+        self.adam_v = tf.get_variable('adam_v', shape=dlatent_variable.shape,
+                                      dtype='float32', initializer=tf.initializers.zeros(), trainable=False)
+        # Per-image mask of slots still being optimized; converged images are frozen by zeroing their updates
+        self.active = tf.get_variable('active', shape=(self.batch_size,),
+                                      dtype='float32', initializer=tf.initializers.ones(), trainable=False)
+        self.add_placeholder("active")
+        self.row_step = tf.get_variable('row_step', shape=(self.batch_size,),
+                                        dtype=tf.int32, initializer=tf.initializers.zeros(), trainable=False)
+        if self.use_fp16:
+            # Only the loss scaling of tflib.Optimizer is used; the Adam update stays our own (in float32).
+            # The scale variable is created here, outside of any while loop, and kept across batches.
+            self.loss_scaling = tflib.Optimizer(name='EncoderLossScaling', use_loss_scaling=True, loss_scaling_init=16.0)
+            self.sess.run(self.loss_scaling.get_loss_scaling_var(self.loss.device).initializer)
+
+        if self.steps_per_call > 1:
+            self._min_op, self.learning_rate, loss_trace, loss_per_image_trace, self.video_frames = self._build_fused_steps(self.steps_per_call)
+            self._fetch_ops = [self._min_op, loss_trace, self.learning_rate, loss_per_image_trace]
+        else:
+            self._min_op, self.learning_rate = self._build_step(self.loss_per_image, dlatent_variable, self.step_value)
+            self._fetch_ops = [self._min_op, self.loss, self.learning_rate, self.loss_per_image]
+            if self.video_size:
+                # From the image of the step's own forward pass: no extra synthesis, and the frame shows the
+                # dlatents the loss (and so the update) was computed from
+                self.video_frames = tf.saturate_cast(self._video_frames(self.loss_image), tf.uint8)
+        self._reset_optimizer = tf.group(tf.variables_initializer([self.adam_m, self.adam_v, self.best_loss, self.best_dlatents, self.active, self.row_step]),
+                                         self._reset_global_step)
+        self._reset_op = tf.group(self._reset_optimizer, *[tf.assign(var, tf.zeros_like(var)) for var in vars_to_optimize])
+
+        # Restart the optimizer state of some slots only (Adam moments, best loss, step count) and mark them active
+        self.reset_rows_placeholder = tf.placeholder(tf.float32, shape=(self.batch_size,))
+        restart = self.reset_rows_placeholder > 0
+        keep = tf.reshape(1 - self.reset_rows_placeholder, [-1] + [1] * (dlatent_variable.shape.ndims - 1))
+        self._reset_rows_op = tf.group(tf.assign(self.adam_m, self.adam_m * keep),
+                                       tf.assign(self.adam_v, self.adam_v * keep),
+                                       tf.assign(self.best_loss, tf.where(restart, tf.fill([self.batch_size], np.inf), self.best_loss)),
+                                       tf.assign(self.row_step, tf.where(restart, tf.zeros_like(self.row_step), self.row_step)),
+                                       tf.assign(self.active, tf.maximum(self.active, self.reset_rows_placeholder)))
+        self.reset_optimizer()
+
+    def _build_fused_steps(self, steps):
+        # Run several optimization steps in a single sess.run with a tf.while_loop. The synthesis and loss graph is
+        # rebuilt inside the loop body so every iteration reads the current dlatents. Returns the loss traces, and the
+        # video frames of the last iteration (video frames from outside the loop would be unordered with its updates).
+        dlatent_variable = self.generator.dlatent_variable
+        frame_shape = [self.batch_size, self.video_size, self.video_size, 3] if self.video_size else []
+
+        def body(i, learning_rate, loss_trace, loss_per_image_trace, frames):
+            with tf.control_dependencies([i]):
+                dlatents = dlatent_variable.read_value()
+                step = self.global_step.read_value()
+                images = self._scheduled_image(dlatents, step)
+                loss_per_image = self._build_loss(images, dlatents, step, name='fused')
+                update, learning_rate = self._build_step(loss_per_image, dlatents, step)
+                if self.video_size:
+                    frames = self._video_frames(images)
+            with tf.control_dependencies([update]):
+                return (i + 1, learning_rate, loss_trace.write(i, tf.math.reduce_mean(loss_per_image)),
+                        loss_per_image_trace.write(i, loss_per_image), tf.identity(frames))
+
+        loop_vars = (tf.constant(0), tf.zeros([self.batch_size], dtype=tf.float32),
+                     tf.TensorArray(tf.float32, size=steps), tf.TensorArray(tf.float32, size=steps), tf.zeros(frame_shape))
+        _, learning_rate, loss_trace, loss_per_image_trace, frames = tf.while_loop(lambda i, *_: i < steps, body, loop_vars,
+                                                                                   parallel_iterations=1)
+        loss_trace = loss_trace.stack()
+        video_frames = tf.saturate_cast(frames, tf.uint8) if self.video_size else None
+        return tf.group(loss_trace), learning_rate, loss_trace, loss_per_image_trace.stack(), video_frames
+
+    def _video_frames(self, images):
+        # Float frames at video_size; images may come out of a tf.case with unknown height and width
+        frames = tf.image.resize_area(images, (self.video_size, self.video_size))
+        return tf.reshape(frames, [self.batch_size, self.video_size, self.video_size, 3])
+
+    def reset(self):
+        # Re-zero the Adam slots, global_step and the optimized dlatents
+        self.sess.run(self._reset_op)
+
+    def reset_optimizer(self):
+        self.sess.run(self._reset_optimizer)
+
+    def reset_rows(self, rows):
+        mask = np.zeros(self.batch_size, dtype=np.float32)
+        mask[rows] = 1
+        self.sess.run(self._reset_rows_op, {self.reset_rows_placeholder: mask})
+
+    def _best_images_tensor(self):
+        # Images synthesized from best_dlatents; the graph is only built on first use
+        if self._best_images is None:
+            self._best_images = tf.saturate_cast(self.generator.synthesize(self.best_dlatents.read_value()), tf.uint8)
+        return self._best_images
+
+    def get_best_images(self):
+        return self.sess.run(self._best_images_tensor())
+
+    def build_signatures(self):
+        # Named inputs and outputs for driving the built encoder graph without this class (see encoder/export.py):
+        #   set_refs: reference images, weight masks, initial dlatents and active mask for a new batch (resets the optimizer)
+        #   step: one optimization call (steps_per_call steps), returns the losses
+        #   get_results: best dlatents, losses and images so far
+        dlatent_variable = self.generator.dlatent_variable
+        self.build_optimizer(dlatent_variable)
+        ref_img = self.fn_ref_placeholder if self.fn_loss is not None else tf.placeholder(tf.float32, shape=self.ref_img.shape)
+        ref_weight = tf.placeholder(tf.float32, shape=self.ref_weight.shape)
+        dlatents = tf.placeholder(dlatent_variable.dtype, shape=dlatent_variable.shape)
+        active = tf.placeholder(tf.float32, shape=(self.batch_size,))
+        with tf.control_dependencies([self._reset_op]):
+            assigns = [tf.assign(self.ref_img, ref_img), tf.assign(self.ref_weight, ref_weight),
+                       tf.assign(dlatent_variable, dlatents), tf.assign(self.active, active)]
+            if self.fn_loss is not None:
+                assigns.append(tf.assign(self.ref_img_features, self.fn_ref_embeddings))
+        with tf.control_dependencies(assigns):
+            num_active = tf.reduce_sum(tf.cast(active > 0, tf.int32))
+
+        min_op, loss, learning_rate, loss_per_image = self._fetch_ops
+        with tf.control_dependencies([min_op]):
+            step_outputs = dict(loss=tf.identity(loss), learning_rate=tf.identity(learning_rate),
+                                loss_per_image=tf.identity(loss_per_image))
+
+        return dict(set_refs=(dict(ref_img=ref_img, ref_weight=ref_weight, dlatents=dlatents, active=active),
+                              dict(num_active=num_active)),
+                    step=(dict(), step_outputs),
+                    get_results=(dict(), dict(dlatents=self.best_dlatents.read_value(), loss=self.best_loss.read_value(),
+                                              images=self._best_images_tensor())))
+
+    def set_active(self, active):
+        self.assign_placeholder("active", np.asarray(active, dtype=np.float32))
+
+    def get_best_dlatents(self):
+        return self.sess.run(self.best_dlatents)
+
+    def get_best_loss(self):
+        return self.sess.run(self.best_loss)
+
+    def optimize(self, vars_to_optimize, iterations=200):
+        fetch_ops = self.get_fetch_ops(vars_to_optimize)
+        self.reset_optimizer()
+        for _ in range(0, iterations, self.steps_per_call):
+            _, loss, lr, loss_per_image = self.sess.run(fetch_ops)
+            yield {"loss":loss, "lr": lr, "loss_per_image": loss_per_image}
 
     def get_fetch_ops(self, vars_to_optimize):
-        vars_to_optimize = vars_to_optimize if isinstance(vars_to_optimize, list) else [vars_to_optimize]
-        optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate)
-        min_op = optimizer.minimize(self.loss, var_list=[vars_to_optimize])
-        self.sess.run([tf.variables_initializer(optimizer.variables()), self._reset_global_step])
-        fetch_ops = [min_op, self.loss, self.learning_rate]
-        return fetch_ops
\ No newline at end of file
+        # With steps_per_call > 1, each run performs that many steps and the losses are traces over those steps
+        self.build_optimizer(vars_to_optimize)
+        return self._fetch_ops
@@ -0,0 +1,104 @@
+import os
+import json
+import time
+import threading
+import contextlib
+from collections import defaultdict
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+
+def peak_bytes(run_metadata):
+    # Highest allocator peak recorded in a traced run, over all devices
+    peak = 0
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            for memory in node_stats.memory:
+                peak = max(peak, memory.peak_bytes)
+    return peak
+
+def peak_rss_bytes():
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # KB on Linux
+
+class Profiler:
+    """Opt-in timing of the encoding stages (image load, masks, embeddings, steps, video, outputs).
+
+    Every stage is recorded with its thread, so stages running on the prefetch or video threads show up on their own
+    rows of the Chrome trace. Every trace_every-th session run also collects TF step stats (RunMetadata), which are
+    merged into the same trace, and the device memory peak. A disabled profiler only forwards session runs.
+    """
+    def __init__(self, enabled=True, trace_every=100):
+        self.enabled = enabled
+        self.trace_every = trace_every
+        self.lock = threading.Lock()
+        self.events = []
+        self.tf_events = []
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.runs = 0
+        self.device_peak_bytes = 0
+        self.start = time.time()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            with self.lock:
+                self.events.append(dict(name=name, ph='X', pid=os.getpid(), tid=threading.get_ident(),
+                                        ts=start * 1e6, dur=(end - start) * 1e6))
+                self.totals[name] += end - start
+                self.counts[name] += 1
+
+    def run(self, sess, fetches, feed_dict=None, name='step'):
+        if not self.enabled:
+            return sess.run(fetches, feed_dict)
+        self.runs += 1
+        if self.trace_every <= 0 or self.runs % self.trace_every != 0:
+            with self.stage(name):
+                return sess.run(fetches, feed_dict)
+        import tensorflow as tf
+        from tensorflow.python.client import timeline
+        run_metadata = tf.RunMetadata()
+        with self.stage(name + '_traced'):
+            result = sess.run(fetches, feed_dict, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                              run_metadata=run_metadata)
+        trace = json.loads(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format(show_memory=True))
+        with self.lock:
+            self.tf_events.extend(trace['traceEvents'])
+            self.device_peak_bytes = max(self.device_peak_bytes, peak_bytes(run_metadata))
+        return result
+
+    def write_chrome_trace(self, path):
+        # Host stages and TF step stats share time.time() microseconds, so they line up in chrome://tracing
+        metadata = [dict(name='process_name', ph='M', pid=os.getpid(), args=dict(name='Python stages'))]
+        with open(path, 'w') as f:
+            json.dump(dict(traceEvents=metadata + self.events + self.tf_events), f)
+
+    def summary(self):
+        wall = time.time() - self.start
+        lines = ['%-24s %8s %12s %12s %8s' % ('stage', 'count', 'total (s)', 'mean (ms)', 'wall %')]
+        for name in sorted(self.totals, key=self.totals.get, reverse=True):
+            total, count = self.totals[name], self.counts[name]
+            lines.append('%-24s %8d %12.3f %12.2f %8.1f' % (name, count, total, 1000 * total / count, 100 * total / wall))
+        lines.append('wall time: %.3f s, peak host memory: %.1f MB, peak device memory (traced steps): %.1f MB'
+                     % (wall, peak_rss_bytes() / 2**20, self.device_peak_bytes / 2**20))
+        return '\n'.join(lines)
+
+    def save(self, profile_dir):
+        os.makedirs(profile_dir, exist_ok=True)
+        self.write_chrome_trace(os.path.join(profile_dir, 'trace.json'))
+        summary = self.summary()
+        with open(os.path.join(profile_dir, 'summary.txt'), 'w') as f:
+            f.write(summary + '\n')
+        return summary
@@ -0,0 +1,101 @@
+import os
+import copy
+import hashlib
+import queue
+import traceback
+import multiprocessing as mp
+
+
+def replica_configs(num_replicas, devices='', threads=0):
+    """(CUDA_VISIBLE_DEVICES, intra-op threads, pinned CPUs) for each replica.
+
+    With devices (comma-separated GPU ids) the replicas are spread round robin over the GPUs. Without, every replica
+    gets its own slice of the available CPU cores, with as many intra-op threads as cores unless threads is given.
+    """
+    if devices:
+        devices = devices.split(',')
+        return [(devices[i % len(devices)], threads, None) for i in range(num_replicas)]
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    configs = []
+    for i in range(num_replicas):
+        replica_cpus = cpus[i * len(cpus) // num_replicas:(i + 1) * len(cpus) // num_replicas] or [cpus[i % len(cpus)]]
+        configs.append(('', threads or len(replica_cpus), replica_cpus))
+    return configs
+
+def replica_for(path, num_replicas):
+    # Replica an image is always sent to, from its content hash
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return int(h.hexdigest(), 16) % num_replicas
+
+def _replica_main(index, encode, args, device, threads, cpus, job_queue, result_queue):
+    try:
+        if cpus is not None and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cpus)
+        tf_config = {'env.CUDA_VISIBLE_DEVICES': device}
+        if threads > 0:
+            tf_config.update({'intra_op_parallelism_threads': threads, 'inter_op_parallelism_threads': 2})
+        def save_result(name, dlatent, img_array, loss):
+            result_queue.put(('result', name, dlatent, img_array, loss))
+        encode(args, iter(job_queue.get, None), save_result, tf_config=tf_config)
+        result_queue.put(('done', index))
+    except Exception:
+        result_queue.put(('error', index, traceback.format_exc()))
+
+def encode_replicas(args, paths, encode, save_result, devices='', threads=0):
+    """Data-parallel encoding with args.replicas worker processes.
+
+    Each replica builds its own session and models and calls encode(args, paths, save_result, tf_config=...) on a
+    stream of image paths pulled from a queue. Results are sent back and saved with save_result in this process only.
+    Without a cache the replicas share one queue. With args.cache_dir every replica keeps its own cache (the index is
+    per process), so each image is routed to a fixed replica by its content hash: re-runs hit the cache and every
+    image is cached once, at the price of a static split of the work. With args.profile_dir every replica saves its
+    own profile to profile_dir/replica<N>.
+    """
+    ctx = mp.get_context('spawn') # a fresh interpreter per replica, so no TF state is inherited
+    result_queue = ctx.Queue()
+    configs = replica_configs(args.replicas, devices, threads)
+    routed = args.cache_dir != ''
+    job_queues = [ctx.Queue() for _ in configs] if routed else [ctx.Queue()] * len(configs)
+
+    workers = []
+    for index, (device, replica_threads, cpus) in enumerate(configs):
+        replica_args = copy.copy(args)
+        if routed:
+            replica_args.cache_dir = os.path.join(args.cache_dir, 'replica%d' % index)
+            replica_args.cache_size = max(args.cache_size // len(configs), 1) # --cache_size stays the total
+        if args.profile_dir != '':
+            replica_args.profile_dir = os.path.join(args.profile_dir, 'replica%d' % index)
+        job_queue = job_queues[index]
+        # Not daemonic: a replica may start its own worker processes (e.g. --mask_workers); it is joined or terminated below
+        worker = ctx.Process(target=_replica_main, args=(index, encode, replica_args, device, replica_threads, cpus, job_queue, result_queue))
+        worker.start()
+        workers.append(worker)
+
+    running = set(range(len(workers)))
+    try:
+        for path in paths:
+            job_queues[replica_for(path, len(configs)) if routed else 0].put(path)
+        for job_queue in job_queues:
+            job_queue.put(None)
+        while running:
+            try:
+                message = result_queue.get(timeout=5)
+            except queue.Empty:
+                crashed = [i for i in running if not workers[i].is_alive()]
+                if crashed:
+                    raise RuntimeError('Encoder replica %d exited with code %s' % (crashed[0], workers[crashed[0]].exitcode))
+                continue
+            if message[0] == 'result':
+                save_result(*message[1:])
+            elif message[0] == 'done':
+                running.discard(message[1])
+            else:
+                raise RuntimeError('Encoder replica %d failed:\n%s' % (message[1], message[2]))
+    finally:
+        for worker in workers:
+            if worker.is_alive() and running:
+                worker.terminate()
+            worker.join()
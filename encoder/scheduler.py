@@ -0,0 +1,87 @@
+import numpy as np
+
+
+class SlotScheduler:
+    """Continuous batching for the encoder.
+
+    Every batch slot encodes its own image. When an image converges (or reaches its iteration budget) its result is
+    handed to on_finished, and the slot is refilled with the next queued image, with fresh dlatents and optimizer
+    state for that row only. The other slots keep optimizing.
+
+    The jobs iterable may also yield None for "nothing queued right now" (e.g. a server's request queue): idle slots
+    are then retried after every step, and run() returns once all slots are idle.
+    """
+    def __init__(self, generator, perceptual_model, monitor=None, iterations=500):
+        self.generator = generator
+        self.perceptual_model = perceptual_model
+        self.monitor = monitor
+        self.iterations = iterations
+        self.batch_size = generator.batch_size
+        self.slots = [None] * self.batch_size
+        self.steps = np.zeros(self.batch_size, dtype=np.int64)
+        self.budgets = np.full(self.batch_size, iterations, dtype=np.int64)
+        self.active = [False] * self.batch_size
+
+    def run(self, jobs, on_finished):
+        """
+        :param jobs: iterable of (name, image_path, loaded_image, initial_dlatent[, iterations]); loaded_image and
+                     initial_dlatent may be None, iterations defaults to the scheduler's
+        :param on_finished: called as on_finished(name, dlatent, image, loss) for every job
+        """
+        fetch_ops = self.perceptual_model.get_fetch_ops(self.generator.dlatent_variable)
+        steps_per_call = self.perceptual_model.steps_per_call
+        jobs = iter(jobs)
+        self.slots = [None] * self.batch_size
+        self.perceptual_model.reset()
+        self.perceptual_model.set_active(np.zeros(self.batch_size))
+        self.active = [False] * self.batch_size
+        self._fill(list(range(self.batch_size)), jobs)
+
+        while any(slot is not None for slot in self.slots):
+            _, loss, lr, loss_per_image = self.perceptual_model.profiler.run(self.perceptual_model.sess, fetch_ops)
+            occupied = np.array([slot is not None for slot in self.slots])
+            self.steps[occupied] += steps_per_call
+            finished = self.steps >= self.budgets
+            if self.monitor is not None:
+                self.monitor.update(loss_per_image)
+                finished |= self.monitor.converged
+            finished = np.flatnonzero(finished & occupied)
+            if len(finished) > 0:
+                best_dlatents = self.perceptual_model.get_best_dlatents()
+                best_images = self.perceptual_model.get_best_images()
+                best_loss = self.perceptual_model.get_best_loss()
+                for row in finished:
+                    on_finished(self.slots[row][0], best_dlatents[row], best_images[row], best_loss[row])
+                    self.slots[row] = None
+            idle = [row for row, slot in enumerate(self.slots) if slot is None]
+            if idle:
+                self._fill(idle, jobs)
+
+    def _fill(self, rows, jobs):
+        new_rows = []
+        for row in rows:
+            job = next(jobs, None)
+            if job is None:
+                break
+            self.slots[row] = job
+            new_rows.append(row)
+
+        if new_rows:
+            new_jobs = [self.slots[row] for row in new_rows]
+            loaded_image = None
+            if all(job[2] is not None for job in new_jobs):
+                loaded_image = np.stack([job[2] for job in new_jobs])
+            self.perceptual_model.set_reference_rows(new_rows, [job[1] for job in new_jobs], loaded_image=loaded_image)
+            self.generator.set_dlatent_rows(new_rows, [job[3] for job in new_jobs])
+            self.perceptual_model.reset_rows(new_rows)
+            self.steps[new_rows] = 0
+            self.budgets[new_rows] = [job[4] if len(job) > 4 and job[4] else self.iterations for job in new_jobs]
+            for row in new_rows:
+                self.active[row] = True
+            if self.monitor is not None:
+                self.monitor.reset(new_rows)
+        occupied = [slot is not None for slot in self.slots]
+        if occupied != self.active:
+            # The queue ran dry: idle slots stop being optimized
+            self.perceptual_model.set_active(occupied)
+            self.active = occupied
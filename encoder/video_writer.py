@@ -0,0 +1,76 @@
+import queue
+import contextlib
+import threading
+import numpy as np
+
+
+class AsyncVideoWriter:
+    """Writes encoding-progress videos on a background thread.
+
+    Frames are queued as uint8 RGB batches (already at video size); a bounded queue keeps memory flat if encoding
+    outruns the encoder, at the cost of blocking the optimization loop until the writer catches up. If writing fails,
+    the thread keeps draining the queue and the error is raised from the next open(), write(), release() or close().
+    """
+    def __init__(self, codec='MJPG', frame_rate=24, size=256, max_queue=64, profiler=None):
+        import cv2
+        self.cv2 = cv2
+        self.fourcc = cv2.VideoWriter_fourcc(*codec)
+        self.frame_rate = frame_rate
+        self.size = size
+        self.writers = {}
+        self.profiler = profiler
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _check(self):
+        if self.error is not None:
+            raise RuntimeError('Video writing failed: %r' % self.error) from self.error
+
+    def open(self, name, path):
+        self._check()
+        self.queue.put(('open', name, path))
+
+    def write(self, names, frames):
+        # frames: (n, size, size, 3) uint8 RGB, one per name; extra (padding) frames are ignored
+        self._check()
+        self.queue.put(('write', list(names), np.asarray(frames)[:len(names)]))
+
+    def release(self, names):
+        self._check()
+        self.queue.put(('release', list(names), None))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue # only drain, so the producer never blocks on a full queue
+            try:
+                self._handle(*item)
+            except Exception as e:
+                self.error = e
+        for writer in self.writers.values():
+            writer.release()
+        self.writers = {}
+
+    def _handle(self, command, names, data):
+        if command == 'open':
+            writer = self.cv2.VideoWriter(data, self.fourcc, self.frame_rate, (self.size, self.size))
+            if not writer.isOpened():
+                raise IOError('Cannot open %s for writing' % data)
+            self.writers[names] = writer
+        elif command == 'write':
+            with self.profiler.stage('video_write') if self.profiler is not None else contextlib.nullcontext():
+                for name, frame in zip(names, data):
+                    self.writers[name].write(self.cv2.cvtColor(frame, self.cv2.COLOR_RGB2BGR))
+        elif command == 'release':
+            for name in names:
+                self.writers.pop(name).release()
@@ -0,0 +1,29 @@
+"""Build the encoder graph once and export it as a SavedModel, for workers that load it with encoder.export.ExportedEncoder."""
+
+import os
+import argparse
+from encoder.export import export_encoder
+from encode_images import add_encoder_arguments, prepare_encoder_arguments, build_models
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the encoder graph and variables as a SavedModel', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('export_dir', help='Directory for the SavedModel (must not exist)')
+    add_encoder_arguments(parser)
+    args, other_args = parser.parse_known_args()
+    prepare_encoder_arguments(args)
+    # Initial dlatents are an input of the export: don't load the ResNet/EfficientNet into the session being saved
+    args.load_resnet = ''
+    args.load_effnet = ''
+    # Video frames are not part of the signatures; don't build their ops into the exported graph
+    args.output_video = False
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    os.makedirs(args.mask_dir, exist_ok=True)
+    generator, perceptual_model, cache, load_batch, predict_dlatents = build_models(args)
+    export_encoder(args.export_dir, perceptual_model)
+    print('Exported encoder for batch size %d, image size %d to %s' % (args.batch_size, args.image_size, args.export_dir))
+
+
+if __name__ == "__main__":
+    main()
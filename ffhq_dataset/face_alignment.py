@@ -4,9 +4,69 @@ import os
 import PIL.Image
 
 
-def image_align(src_file, dst_file, face_landmarks, output_size=1024, transform_size=4096, enable_padding=True, x_scale=1, y_scale=1, em_scale=0.1, alpha=False):
+def adaptive_transform_size(qsize, output_size, supersample=1.0, max_transform_size=4096):
+        # Smallest multiple of output_size that samples the (shrunk) crop quad at about its own resolution, times
+        # supersample: enough for the bilinear QUAD transform not to alias before the ANTIALIAS downsampling
+        factor = int(np.ceil(qsize * supersample / output_size))
+        return output_size * int(np.clip(factor, 1, max(max_transform_size // output_size, 1)))
+
+def _border_mask(pad, h, w, rows, cols):
+        # Padding mask of the (h, w) padded image over rows x cols: > 0 inside the padding, <= -1/3 from 4/3 of
+        # the padding width inwards
+        y, x = np.ogrid[rows[0]:rows[1], cols[0]:cols[1]]
+        mask = np.maximum(1.0 - np.minimum(np.float32(x) / pad[0], np.float32(w-1-x) / pad[2]), 1.0 - np.minimum(np.float32(y) / pad[1], np.float32(h-1-y) / pad[3]))
+        return mask[..., np.newaxis]
+
+def pad_and_blend(img, pad, blur, alpha=False, median_samples=65536):
+        # Reflect-pad img by pad (left, top, right, bottom), blur towards the borders and fade the padding to the
+        # median colour, as the FFHQ alignment does on the whole float image. The blending only reaches 4/3 of the
+        # padding width from each border, so only those bands (plus the gaussian radius) are filtered in float32;
+        # the rest stays uint8 and the median is taken on a subsample. Returns a uint8 RGB or RGBA array.
+        img = np.pad(np.asarray(img), ((pad[1], pad[3]), (pad[0], pad[2]), (0, 0)), 'reflect')
+        h, w, _ = img.shape
+        top = min(int(np.ceil(pad[1] * 4 / 3)), h)
+        bottom = min(int(np.ceil(pad[3] * 4 / 3)), h - top)
+        left = min(int(np.ceil(pad[0] * 4 / 3)), w)
+        right = min(int(np.ceil(pad[2] * 4 / 3)), w - left)
+        bands = [((0, top), (0, w)), ((h - bottom, h), (0, w)), ((top, h - bottom), (0, left)), ((top, h - bottom), (w - right, w))]
+        bands = [(rows, cols) for rows, cols in bands if rows[1] > rows[0] and cols[1] > cols[0]]
+
+        # Blur every band from the unblended image, with enough context for the gaussian (scipy's truncate=4.0)
+        radius = int(4.0 * blur + 0.5)
+        blended = []
+        for rows, cols in bands:
+            r0, c0 = max(rows[0] - radius, 0), max(cols[0] - radius, 0)
+            src = np.float32(img[r0:min(rows[1] + radius, h), c0:min(cols[1] + radius, w)])
+            blurred = scipy.ndimage.gaussian_filter(src, [blur, blur, 0])
+            index = (slice(rows[0] - r0, rows[1] - r0), slice(cols[0] - c0, cols[1] - c0))
+            band, mask = src[index], _border_mask(pad, h, w, rows, cols)
+            band += (blurred[index] - band) * np.clip(mask * 3.0 + 1.0, 0.0, 1.0)
+            blended.append((rows, cols, band, mask))
+        for rows, cols, band, _ in blended:
+            img[rows[0]:rows[1], cols[0]:cols[1]] = np.clip(np.rint(band), 0, 255)
+
+        step = max(int(np.sqrt(h * w / median_samples)), 1)
+        median = np.median(img[::step, ::step].reshape(-1, img.shape[2]), axis=0)
+        for rows, cols, band, mask in blended:
+            band += (median - band) * np.clip(mask, 0.0, 1.0)
+            img[rows[0]:rows[1], cols[0]:cols[1]] = np.clip(np.rint(band), 0, 255)
+        if alpha:
+            opacity = np.full((h, w, 1), 255, dtype=np.uint8)
+            for rows, cols, _, mask in blended:
+                opacity[rows[0]:rows[1], cols[0]:cols[1]] = np.clip(np.rint((1 - np.clip(3.0 * mask, 0.0, 1.0)) * 255), 0, 255)
+            img = np.concatenate((img, opacity), axis=2)
+        return img
+
+def _image_size(img):
+        return (img.shape[1], img.shape[0]) if isinstance(img, np.ndarray) else img.size
+
+def image_align(src_file, dst_file, face_landmarks, output_size=1024, transform_size=4096, enable_padding=True, x_scale=1, y_scale=1, em_scale=0.1, alpha=False, supersample=1.0):
         # Align function from FFHQ dataset pre-processing step
         # https://github.com/NVlabs/ffhq-dataset/blob/master/download_ffhq.py
+        # transform_size=None picks the transform size per face (see adaptive_transform_size) instead of a fixed 4096.
+        # src_file may also be the image already decoded, as a PIL image or an RGB uint8 array (e.g. the one the
+        # landmarks were detected on); an array is cropped as a view and only copied when padded or warped.
+        # Returns the aligned PIL image; it is also saved as PNG unless dst_file is None.
 
         lm = np.array(face_landmarks)
         lm_chin          = lm[0  : 17]  # left-right
@@ -40,14 +100,19 @@ def image_align(src_file, dst_file, face_landmarks, output_size=1024, transform_
         qsize = np.hypot(*x) * 2
 
         # Load in-the-wild image.
-        if not os.path.isfile(src_file):
+        if isinstance(src_file, (np.ndarray, PIL.Image.Image)):
+            img = src_file
+        elif not os.path.isfile(src_file):
             print('\nCannot find source image. Please run "--wilds" before "--align".')
             return
-        img = PIL.Image.open(src_file)
+        else:
+            img = PIL.Image.open(src_file)
 
         # Shrink.
         shrink = int(np.floor(qsize / output_size * 0.5))
         if shrink > 1:
+            if isinstance(img, np.ndarray):
+                img = PIL.Image.fromarray(img)
             rsize = (int(np.rint(float(img.size[0]) / shrink)), int(np.rint(float(img.size[1]) / shrink)))
             img = img.resize(rsize, PIL.Image.ANTIALIAS)
             quad /= shrink
@@ -56,37 +121,32 @@ def image_align(src_file, dst_file, face_landmarks, output_size=1024, transform_
         # Crop.
         border = max(int(np.rint(qsize * 0.1)), 3)
         crop = (int(np.floor(min(quad[:,0]))), int(np.floor(min(quad[:,1]))), int(np.ceil(max(quad[:,0]))), int(np.ceil(max(quad[:,1]))))
-        crop = (max(crop[0] - border, 0), max(crop[1] - border, 0), min(crop[2] + border, img.size[0]), min(crop[3] + border, img.size[1]))
-        if crop[2] - crop[0] < img.size[0] or crop[3] - crop[1] < img.size[1]:
-            img = img.crop(crop)
+        size = _image_size(img)
+        crop = (max(crop[0] - border, 0), max(crop[1] - border, 0), min(crop[2] + border, size[0]), min(crop[3] + border, size[1]))
+        if crop[2] - crop[0] < size[0] or crop[3] - crop[1] < size[1]:
+            img = img[crop[1]:crop[3], crop[0]:crop[2]] if isinstance(img, np.ndarray) else img.crop(crop)
             quad -= crop[0:2]
 
         # Pad.
         pad = (int(np.floor(min(quad[:,0]))), int(np.floor(min(quad[:,1]))), int(np.ceil(max(quad[:,0]))), int(np.ceil(max(quad[:,1]))))
-        pad = (max(-pad[0] + border, 0), max(-pad[1] + border, 0), max(pad[2] - img.size[0] + border, 0), max(pad[3] - img.size[1] + border, 0))
+        size = _image_size(img)
+        pad = (max(-pad[0] + border, 0), max(-pad[1] + border, 0), max(pad[2] - size[0] + border, 0), max(pad[3] - size[1] + border, 0))
         if enable_padding and max(pad) > border - 4:
             pad = np.maximum(pad, int(np.rint(qsize * 0.3)))
-            img = np.pad(np.float32(img), ((pad[1], pad[3]), (pad[0], pad[2]), (0, 0)), 'reflect')
-            h, w, _ = img.shape
-            y, x, _ = np.ogrid[:h, :w, :1]
-            mask = np.maximum(1.0 - np.minimum(np.float32(x) / pad[0], np.float32(w-1-x) / pad[2]), 1.0 - np.minimum(np.float32(y) / pad[1], np.float32(h-1-y) / pad[3]))
-            blur = qsize * 0.02
-            img += (scipy.ndimage.gaussian_filter(img, [blur, blur, 0]) - img) * np.clip(mask * 3.0 + 1.0, 0.0, 1.0)
-            img += (np.median(img, axis=(0,1)) - img) * np.clip(mask, 0.0, 1.0)
-            img = np.uint8(np.clip(np.rint(img), 0, 255))
-            if alpha:
-                mask = 1-np.clip(3.0 * mask, 0.0, 1.0)
-                mask = np.uint8(np.clip(np.rint(mask*255), 0, 255))
-                img = np.concatenate((img, mask), axis=2)
-                img = PIL.Image.fromarray(img, 'RGBA')
-            else:
-                img = PIL.Image.fromarray(img, 'RGB')
+            img = pad_and_blend(img, pad, qsize * 0.02, alpha)
+            img = PIL.Image.fromarray(img, 'RGBA' if alpha else 'RGB')
             quad += pad[:2]
 
         # Transform.
+        if isinstance(img, np.ndarray):
+            img = PIL.Image.fromarray(img)
+        if transform_size is None:
+            transform_size = adaptive_transform_size(qsize, output_size, supersample)
         img = img.transform((transform_size, transform_size), PIL.Image.QUAD, (quad + 0.5).flatten(), PIL.Image.BILINEAR)
         if output_size < transform_size:
             img = img.resize((output_size, output_size), PIL.Image.ANTIALIAS)
 
         # Save aligned image.
-        img.save(dst_file, 'PNG')
+        if dst_file is not None:
+            img.save(dst_file, 'PNG')
+        return img
@@ -1,4 +1,6 @@
 import dlib
+import numpy as np
+import PIL.Image
 
 
 class LandmarksDetector:
@@ -9,9 +11,22 @@ class LandmarksDetector:
         self.detector = dlib.get_frontal_face_detector() # cnn_face_detection_model_v1 also can be used
         self.shape_predictor = dlib.shape_predictor(predictor_model_path)
 
-    def get_landmarks(self, image):
-        img = dlib.load_rgb_image(image)
-        dets = self.detector(img, 1)
+    def get_landmarks(self, image, detect_size=0):
+        """
+        :param image: path to the image, or the image already decoded as an RGB uint8 array (e.g. by dlib.load_rgb_image)
+        :param detect_size: if > 0, faces are detected on a copy downscaled to at most this size on its longer side;
+            landmarks are still predicted on the full image
+        """
+        img = image if isinstance(image, np.ndarray) else dlib.load_rgb_image(image)
+        height, width = img.shape[:2]
+        if 0 < detect_size < max(height, width):
+            scale = detect_size / max(height, width)
+            small_size = (max(int(np.rint(width * scale)), 1), max(int(np.rint(height * scale)), 1))
+            small = np.asarray(PIL.Image.fromarray(img).resize(small_size, PIL.Image.BILINEAR))
+            sx, sy = width / small_size[0], height / small_size[1]
+            dets = [dlib.rectangle(int(d.left() * sx), int(d.top() * sy), int(d.right() * sx), int(d.bottom() * sy)) for d in self.detector(small, 1)]
+        else:
+            dets = self.detector(img, 1)
 
         for detection in dets:
             try:
@@ -0,0 +1,43 @@
+"""Generate the face masks used by encode_images.py --face_mask for a whole folder, in parallel, ahead of encoding."""
+
+import os
+import time
+import argparse
+from concurrent.futures import as_completed
+from tqdm import tqdm
+from encoder.face_masks import MaskPrecomputer
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute face masks for encoding', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('src_dir', help='Directory with images for encoding')
+    parser.add_argument('--mask_dir', default='masks', help='Directory for storing the masks')
+    parser.add_argument('--image_size', default=512, help='Size of images for perceptual model (masks are generated at this size)', type=int)
+    parser.add_argument('--use_grabcut', default=True, help='Use grabcut algorithm on the face mask to better segment the foreground', type=bool)
+    parser.add_argument('--scale_mask', default=1.5, help='Look over a wider section of foreground for grabcut', type=float)
+    parser.add_argument('--workers', default=0, help='Number of worker processes; 0 for one per CPU core', type=int)
+    args = parser.parse_args()
+
+    ref_images = [os.path.join(args.src_dir, x) for x in sorted(os.listdir(args.src_dir))]
+    ref_images = list(filter(os.path.isfile, ref_images))
+    os.makedirs(args.mask_dir, exist_ok=True)
+
+    start = time.time()
+    precomputer = MaskPrecomputer(args.mask_dir, args.image_size, args.use_grabcut, args.scale_mask, workers=args.workers or None)
+    precomputer.submit(ref_images)
+    futures = {future: path for path, future in precomputer.futures.items()}
+    failed = 0
+    for future in tqdm(as_completed(futures), total=len(futures)):
+        error = future.result()
+        if error is not None:
+            print("Exception in mask generation for " + futures[future])
+            print(error)
+            failed += 1
+    precomputer.close()
+    elapsed = time.time() - start
+    print('%d masks generated (%d failed, %d already present) in %.1f s, %.2f masks/s'
+          % (len(futures) - failed, failed, len(ref_images) - len(futures), elapsed, len(futures) / max(elapsed, 1e-6)))
+
+
+if __name__ == "__main__":
+    main()
@@ -536,12 +536,15 @@ def G_synthesis(
     fused_scale         = 'auto',       # True = fused convolution + scaling, False = separate ops, 'auto' = decide automatically.
     blur_filter         = [1,2,1],      # Low-pass filter to apply when resampling activations. None = no filtering.
     structure           = 'auto',       # 'fixed' = no progressive growing, 'linear' = human-readable, 'recursive' = efficient, 'auto' = select automatically.
+    output_lod          = 0,            # 'fixed' structure only: stop this many doublings short of the full resolution and output the lower-resolution image directly.
     is_template_graph   = False,        # True = template graph constructed by the Network class, False = actual evaluation.
     force_clean_graph   = False,        # True = construct a clean graph that looks nice in TensorBoard, False = default behavior.
     **_kwargs):                         # Ignore unrecognized keyword args.
 
     resolution_log2 = int(np.log2(resolution))
     assert resolution == 2**resolution_log2 and resolution >= 4
+    assert 0 <= output_lod <= resolution_log2 - 2
+    assert output_lod == 0 or structure == 'fixed'
     def nf(stage): return min(int(fmap_base / (2.0 ** (stage * fmap_decay))), fmap_max)
     def PN(x): return pixel_norm(x, epsilon=epsilon) if use_pixel_norm else x
     def IN(x): return instance_norm(x, epsilon=epsilon) if use_instance_norm else x
@@ -607,9 +610,9 @@ def G_synthesis(
 
     # Fixed structure: simple and efficient, but does not support progressive growing.
     if structure == 'fixed':
-        for res in range(3, resolution_log2 + 1):
+        for res in range(3, resolution_log2 - output_lod + 1):
             x = block(res, x)
-        images_out = torgb(resolution_log2, x)
+        images_out = torgb(resolution_log2 - output_lod, x)
 
     # Linear structure: simple but inefficient.
     if structure == 'linear':